@@ -1,35 +1,39 @@
 # backend/app.py
 
 import os
+import hmac
+import time
 import random
-import json
-import pandas as pd
-from flask import Flask, request, jsonify, send_from_directory
+import threading
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
-from redis import Redis
+from redis.exceptions import RedisError
 from dotenv import load_dotenv
-from team_logic import make_teams
-import numpy as np
-from datetime import datetime, timedelta
+from storage import connect_redis, create_storage
+from events import create_broadcaster, format_event
+from jobs import completed_team_job, restart_options, run_team_batch, submit_team_job
+from result_cache import ResultCache, result_key
+from log_config import get_logger, log_event
+from metrics import init_app as init_metrics, stage, observe_stage, observe_surveys
+from survey_io import (EXPORT_BATCH_SIZE, IMPORT_FORMATS, PARSERS, SurveyError, complete_survey, export_ndjson,
+                       export_surveys_csv, export_teams_csv, import_surveys, team_rows, validate_survey)
+from datetime import datetime
 from whitenoise import WhiteNoise
-import uuid
-import sys
-import traceback
+import logging
 
 load_dotenv()
 
+logger = get_logger('app')
+
 # Get the absolute path for static files
 root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 static_folder = os.path.join(root_dir, 'static')
-print(f"Root directory: {root_dir}")
-print(f"Static folder path: {static_folder}")
-print(f"Static folder exists: {os.path.exists(static_folder)}")
-if os.path.exists(static_folder):
-    print(f"Static folder contents: {os.listdir(static_folder)}")
 
 app = Flask(__name__, static_folder=static_folder, static_url_path='')
 # Add Whitenoise for static files
 app.wsgi_app = WhiteNoise(app.wsgi_app, root=static_folder)
+# Per-route latency, stage timings and payload sizes, served at /metrics
+init_metrics(app)
 
 # Configure CORS with Heroku domain
 CORS(app, resources={
@@ -40,73 +44,85 @@ CORS(app, resources={
     }
 })
 
-# Try to connect to Redis, fall back to in-memory storage if not available
-try:
-    redis_url = os.environ.get('REDISCLOUD_URL') or os.environ.get('REDIS_URL')
-    if not redis_url:
-        print("No Redis URL found, falling back to in-memory storage")
-        redis_client = None
-    else:
-        print(f"Attempting to connect to Redis at {redis_url}")
-        redis_client = Redis.from_url(redis_url, decode_responses=True)
-        # Test the connection
+# Redis when a URL is configured, otherwise in-memory storage (development only:
+# every process then has its own sessions)
+redis_client = None
+redis_url = os.environ.get('REDISCLOUD_URL') or os.environ.get('REDIS_URL')
+if not redis_url:
+    logger.warning("no Redis URL found, falling back to in-memory storage")
+else:
+    try:
+        redis_client = connect_redis(redis_url)
+    except ValueError as e:
+        logger.warning("invalid Redis URL (%s), falling back to in-memory storage", e)
+if redis_client is not None:
+    try:
         redis_client.ping()
-        print("Successfully connected to Redis")
-except Exception as e:
-    print(f"Failed to connect to Redis: {str(e)}")
-    print("Full error:", traceback.format_exc())
-    print("Falling back to in-memory storage")
-    redis_client = None
+        logger.info("connected to Redis")
+    except RedisError as e:
+        # Stay on Redis: the client reconnects with backoff once it is reachable,
+        # instead of this process drifting apart from the others in memory
+        logger.warning("Redis not reachable yet (%s), will keep retrying", e)
 
-# In-memory storage for sessions
-sessions = {}
+# Event streams: seconds between keepalives, lifetime of one stream, and the
+# reconnect delay (ms) suggested to the browser
+EVENT_KEEPALIVE_SECONDS = 15
+EVENT_STREAM_SECONDS = int(os.environ.get('EVENT_STREAM_SECONDS', 300))
+EVENT_RETRY_MS = 2000
+# Threads of a worker kept for requests other than event streams; clients
+# turned away beyond that poll instead
+EVENT_RESERVED_THREADS = 16
+MAX_EVENT_STREAMS = int(os.environ.get(
+    'MAX_EVENT_STREAMS', max(1, int(os.environ.get('GUNICORN_THREADS', 64)) - EVENT_RESERVED_THREADS)))
+event_stream_slots = threading.BoundedSemaphore(MAX_EVENT_STREAMS)
 
-def get_redis_key(key):
-    try:
-        if redis_client:
-            value = redis_client.get(key)
-            return value if value else None
-        return sessions.get(key)
-    except Exception as e:
-        print(f"Error getting Redis key {key}: {str(e)}")
-        return sessions.get(key)
+# Bearer token for the admin routes, which are disabled while it is unset
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
 
-def set_redis_key(key, value, expire_seconds=None):
-    try:
-        if redis_client:
-            if expire_seconds:
-                redis_client.setex(key, expire_seconds, value)
-            else:
-                redis_client.set(key, value)
-        sessions[key] = value
-    except Exception as e:
-        print(f"Error setting Redis key {key}: {str(e)}")
-        sessions[key] = value
+# Upper bound on the parallel restarts of one team generation
+MAX_RESTARTS = 32
 
-def delete_redis_key(key):
-    if redis_client:
-        redis_client.delete(key)
-    else:
-        sessions.pop(key, None)
+# Characteristics a session asks about unless its settings say otherwise
+DEFAULT_CHARACTERISTICS = ["tech_skills", "comm_skills", "creative_skills", "leadership_skills"]
 
-def get_session_data(sid):
-    try:
-        if redis_client:
-            data = redis_client.get(f"session:{sid}")
-            return json.loads(data) if data else None
-        return sessions.get(sid)
-    except Exception as e:
-        print(f"Error getting session {sid}: {str(e)}")
-        return sessions.get(sid)
+# Default cap (MB) on the memory used for the similarity matrix of one session
+DEFAULT_MEMORY_LIMIT_MB = float(os.environ.get('SIMILARITY_MEMORY_LIMIT_MB', 1024))
+
+# Cap (MB) on the feature and similarity matrices cached by one process, over all sessions
+FEATURE_CACHE_MB = float(os.environ.get('FEATURE_CACHE_MB', 2048))
 
-def set_session(sid, data):
+# Session storage: Redis when connected, otherwise in-memory
+storage = create_storage(redis_client)
+
+# Per-session feature matrices, updated as surveys come in. NumPy and the
+# team logic are imported with the first team generation, not at startup,
+# so workers boot quickly; until then there is nothing cached to update.
+feature_store = None
+
+def get_feature_store():
+    global feature_store
+    if feature_store is None:
+        from feature_store import FeatureStore
+        feature_store = FeatureStore(max_bytes=FEATURE_CACHE_MB * 1024 * 1024)
+    return feature_store
+
+# Team-generation results keyed on survey data and settings
+result_cache = ResultCache(storage)
+
+# Pushes session updates to the clients following /events
+broadcaster = create_broadcaster(redis_client)
+
+def publish_event(session_id, event_type, **fields):
+    """Send an update to the session's event stream; failures only cost the push"""
     try:
-        if redis_client:
-            redis_client.set(f"session:{sid}", json.dumps(data))
-        sessions[sid] = data
-    except Exception as e:
-        print(f"Error setting session {sid}: {str(e)}")
-        sessions[sid] = data
+        broadcaster.publish(session_id, dict(fields, type=event_type))
+    except RedisError as e:
+        logger.warning("could not publish %s event for session %s: %s", event_type, session_id, e)
+
+@app.errorhandler(RedisError)
+def storage_unavailable(e):
+    logger.warning("storage unavailable: %s", e)
+    return jsonify({'error': 'Storage temporarily unavailable'}), 503
 
 def generate_session_id():
     """Generate a 6-digit session ID."""
@@ -123,13 +139,7 @@ def serve_static(path):
 @app.route("/api/session", methods=["POST"])
 def create_session():
     try:
-        session_id = generate_session_id()
-        # Keep generating until we get a unique ID
-        while get_redis_key(f'session:{session_id}'):
-            session_id = generate_session_id()
-            
         data = {
-            'id': session_id,
             'created_at': datetime.now().isoformat(),
             'surveys': [],
             'teams': [],
@@ -139,216 +149,614 @@ def create_session():
                 'team_size': 4
             }
         }
-        print(f"Creating new session with ID: {session_id}")
-        set_redis_key(f'session:{session_id}', json.dumps(data))
+        # Keep generating until we get a unique ID
+        session_id = generate_session_id()
+        while not storage.create_session(session_id, data):
+            session_id = generate_session_id()
+        data = dict(id=session_id, **data)
+        log_event(logger, logging.INFO, "session created", session_id=session_id)
         return jsonify(data)
+    except RedisError:
+        # Answered with 503 by storage_unavailable
+        raise
     except Exception as e:
-        print(f"Error creating session: {str(e)}")
-        print("Full error:", traceback.format_exc())
+        logger.exception("error creating session")
         return jsonify({'error': str(e)}), 500
 
 @app.route("/api/session/<session_id>", methods=["GET"])
 def get_session(session_id):
-    data = get_redis_key(f'session:{session_id}')
+    data = storage.get_session(session_id)
     if data:
-        return jsonify(json.loads(data))
+        return jsonify(data)
     return jsonify({'error': 'Session not found'}), 404
 
 @app.route("/api/session/<session_id>/survey", methods=["POST"])
 def submit_survey(session_id):
     try:
-        data = request.json
-        session_data = get_redis_key(f'session:{session_id}')
-        if not session_data:
+        settings = storage.get_settings(session_id)
+        if settings is None:
             return jsonify({'error': 'Session not found'}), 404
         
-        session_data = json.loads(session_data)
+        # Checked against the session's characteristics and converted to numbers once, here
+        try:
+            # Read directly: team_options() would import the optimizer and NumPy for every participant
+            data = validate_survey(request.get_json(silent=True),
+                                   settings.get('characteristics', DEFAULT_CHARACTERISTICS))
+        except SurveyError as e:
+            return jsonify({'error': str(e)}), 400
         
         # Check if session is in anonymous mode
-        is_anonymous = session_data.get('settings', {}).get('anonymous_mode', False)
+        is_anonymous = settings.get('anonymous_mode', False)
         
         # Generate a unique ID for this survey if not provided
         if 'id' not in data:
-            data['id'] = f'user_{len(session_data["surveys"])}'
-            
-        # In anonymous mode, ensure we have a name for the backend
-        if is_anonymous and 'name' not in data:
-            data['name'] = f'Anonymous User {data["id"]}'
+            data['id'] = f'user_{storage.next_survey_number(session_id)}'
+        complete_survey(data, is_anonymous)
             
-        # Add timestamp if not present
-        if 'timestamp' not in data:
-            data['timestamp'] = datetime.now().isoformat()
-            
-        session_data['surveys'].append(data)
-        set_redis_key(f'session:{session_id}', json.dumps(session_data))
+        # Atomic append, so concurrent submissions cannot overwrite each other
+        with stage('store'):
+            index = storage.append_survey(session_id, data)
+        if feature_store is not None:
+            with stage('features'):
+                feature_store.append(session_id, data, index)
+        observe_surveys(index + 1)
+        result_cache.invalidate(session_id)
+        publish_event(session_id, 'survey', survey_count=index + 1,
+                      survey={'id': data['id'], 'name': data.get('name', data['id'])})
         
         # Return the updated survey with its ID
         return jsonify({
             'survey': data,
-            'surveys': session_data['surveys'],
+            'survey_count': index + 1,
             'currentUser': data['id']
         })
-    except Exception as e:
-        print(f"Error submitting survey: {str(e)}")
-        print("Full error:", traceback.format_exc())
+    except RedisError:
+        # Answered with 503 by storage_unavailable
+        raise
+    except Exception:
+        logger.exception("error submitting survey to session %s", session_id)
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route("/api/session/<session_id>/surveys/import", methods=["POST"])
+def import_surveys_route(session_id):
+    try:
+        settings = storage.get_settings(session_id)
+        if settings is None:
+            return jsonify({'error': 'Session not found'}), 404
+        
+        # Format from ?format=, otherwise from the content type
+        import_format = request.args.get('format')
+        if import_format is None:
+            import_format = 'ndjson' if 'json' in (request.mimetype or '') else 'csv'
+        if import_format not in IMPORT_FORMATS:
+            return jsonify({'error': f'Unsupported format: {import_format}'}), 400
+        
+        # Rows are parsed straight from the request stream and stored batch by batch
+        characteristics = settings.get('characteristics', DEFAULT_CHARACTERISTICS)
+        rows = PARSERS[import_format](request.stream)
+        
+        def extend_features(surveys, start):
+            if feature_store is not None:
+                feature_store.extend(session_id, surveys, start)
+        
+        with stage('store'):
+            result = import_surveys(
+                storage, session_id, rows, characteristics,
+                anonymous=settings.get('anonymous_mode', False),
+                on_batch=extend_features
+            )
+        observe_surveys(result['survey_count'])
+        if result['imported']:
+            result_cache.invalidate(session_id)
+            publish_event(session_id, 'surveys', survey_count=result['survey_count'], imported=result['imported'])
+        log_event(logger, logging.INFO, "surveys imported", session_id=session_id, format=import_format,
+                  imported=result['imported'], rejected=result['rejected'])
+        return jsonify(result)
+    except UnicodeDecodeError:
+        return jsonify({'error': 'Import must be UTF-8 encoded'}), 400
+    except RedisError:
+        # Answered with 503 by storage_unavailable
+        raise
+    except Exception:
+        logger.exception("error importing surveys into session %s", session_id)
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route("/api/session/<session_id>/surveys/export", methods=["GET"])
+def export_surveys(session_id):
+    settings = storage.get_settings(session_id)
+    if settings is None:
+        return jsonify({'error': 'Session not found'}), 404
+    surveys = storage.iter_surveys(session_id, EXPORT_BATCH_SIZE)
+    if request.args.get('format') == 'ndjson':
+        return Response(export_ndjson(surveys), mimetype='application/x-ndjson')
+    characteristics = settings.get('characteristics', DEFAULT_CHARACTERISTICS)
+    return Response(export_surveys_csv(surveys, characteristics), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename=surveys_{session_id}.csv'})
+
+@app.route("/api/session/<session_id>/teams/export", methods=["GET"])
+def export_teams(session_id):
+    teams = storage.get_teams(session_id)
+    if teams is None:
+        return jsonify({'error': 'Session not found'}), 404
+    teams = display_teams(teams)
+    if request.args.get('format') == 'ndjson':
+        return Response(export_ndjson(team_rows(teams)), mimetype='application/x-ndjson')
+    return Response(export_teams_csv(teams), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename=teams_{session_id}.csv'})
+
+class SettingsError(ValueError):
+    """Team generation settings that cannot be used"""
+
+def check_settings(settings):
+    """Raise SettingsError unless teams can be generated with these settings
+
+    Run on the merged settings wherever they come from (a save, a
+    generation request or an admin regeneration), so a bad value is
+    rejected with 400 instead of failing the generation. The constraints,
+    if any, are replaced by their checked copy.
+    """
+    from constraints import ConstraintError, validate_constraints
+    from optimizer import DEFAULT_TIME_BUDGET, OPTIMIZERS
+    from similarity import SIMILARITY_MODES
+    from team_logic import GROUPINGS
+    optimizer = settings.get('optimizer', 'annealing')
+    if optimizer is not None and optimizer not in OPTIMIZERS:
+        raise SettingsError(f'optimizer must be one of {", ".join(OPTIMIZERS)}')
+    if settings.get('similarity_mode', 'auto') not in SIMILARITY_MODES:
+        raise SettingsError(f'similarity_mode must be one of {", ".join(SIMILARITY_MODES)}')
+    if settings.get('grouping', 'knn') not in GROUPINGS:
+        raise SettingsError(f'grouping must be one of {", ".join(GROUPINGS)}')
+    characteristics = settings.get('characteristics', DEFAULT_CHARACTERISTICS)
+    if not isinstance(characteristics, list) or not all(isinstance(char, str) for char in characteristics):
+        raise SettingsError('characteristics must be a list of names')
+    # Converted the way team_options converts them; the form sends numbers as strings
+    for name, convert, default, minimum in (
+            ('team_size', int, 4, 1),
+            ('similarity_threshold', float, 50, None),
+            ('time_budget', float, DEFAULT_TIME_BUDGET, 0),
+            ('memory_limit_mb', float, DEFAULT_MEMORY_LIMIT_MB, 0)):
+        try:
+            value = convert(settings.get(name, default))
+        except (TypeError, ValueError):
+            raise SettingsError(f'{name} must be a number') from None
+        if minimum is not None and not value >= minimum:
+            raise SettingsError(f'{name} must be at least {minimum}')
+    for name in ('seed', 'restarts', 'max_iterations'):
+        value = settings.get(name)
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0):
+            raise SettingsError(f'{name} must be a non-negative integer')
+    if not 1 <= (settings.get('restarts', 1) or 0) <= MAX_RESTARTS:
+        raise SettingsError(f'restarts must be between 1 and {MAX_RESTARTS}')
+    if 'constraints' in settings:
+        try:
+            settings['constraints'] = validate_constraints(settings['constraints'])
+        except ConstraintError as e:
+            raise SettingsError(str(e)) from None
+
+def team_options(settings):
+    """make_teams keyword arguments from session settings"""
+    from optimizer import DEFAULT_TIME_BUDGET
+    return {
+        'team_size': int(settings.get('team_size', 4)),
+        'team_approach': settings.get('team_approach', 'homogeni'),
+        'characteristics': settings.get('characteristics', DEFAULT_CHARACTERISTICS),
+        'similarity_threshold': float(settings.get('similarity_threshold', 50)),
+        'optimizer': settings.get('optimizer', 'annealing'),
+        'time_budget': float(settings.get('time_budget', DEFAULT_TIME_BUDGET)),
+        'similarity_mode': settings.get('similarity_mode', 'auto'),
+        'grouping': settings.get('grouping', 'knn'),
+        'memory_limit_mb': float(settings.get('memory_limit_mb', DEFAULT_MEMORY_LIMIT_MB)),
+        'constraints': settings.get('constraints'),
+        'seed': int(settings['seed']) if settings.get('seed') is not None else None,
+        'max_iterations': int(settings['max_iterations']) if settings.get('max_iterations') else None
+    }
+
+def team_restarts(settings):
+    """Number of independent seeded runs whose best result is kept"""
+    return min(max(int(settings.get('restarts', 1)), 1), MAX_RESTARTS)
+
+def generate(surveys, session_features, options, restarts=1):
+    """make_teams result for a session's surveys
+
+    With restarts, the runs go to the process pool (the swap search is pure
+    Python, so threads would share one core), JOB_WORKERS at a time, and the
+    best is kept. They share the cached similarity matrix, if any, through
+    shared memory instead of each building one.
+    """
+    from team_logic import best_result, make_teams
+    # The cached dense matrix only stands in for what make_teams would build in these modes
+    cached_similarity = None
+    if options['similarity_mode'] in ('auto', 'dense'):
+        cached_similarity = session_features.similarity
+    if restarts > 1 and options['optimizer']:
+        features = session_features.features
+        runs = run_team_batch(storage, [(surveys, features, run, cached_similarity)
+                                        for run in restart_options(options, restarts)])
+        results = [result for result, error in runs if error is None]
+        if not results:
+            raise runs[0][1]
+        return best_result(results, options['team_approach'])
+    return make_teams(
+        users=surveys,  # Pass the raw survey data
+        return_details=True,
+        features=session_features.features,
+        similarity_matrix=cached_similarity,
+        **options
+    )
+
+def format_teams(teams, surveys, positions=None):
+    """Replace member ids with id/name records
+
+    positions maps survey ids to their index in surveys; it is built here
+    when the caller has none, so every member is found in constant time.
+    """
+    if positions is None:
+        positions = {}
+        for position, survey in enumerate(surveys):
+            positions.setdefault(survey.get('id'), position)
+    formatted_teams = []
+    for team in teams:
+        team_members = []
+        for member_id in team:
+            position = positions.get(member_id)
+            if position is not None:
+                team_members.append({
+                    'id': member_id,
+                    'name': surveys[position].get('name', member_id)
+                })
+        if team_members:  # Only add teams that have members
+            formatted_teams.append(team_members)
+    return formatted_teams
+
+def display_teams(teams):
+    """Display-ready teams; members stored by older versions may be plain ids"""
+    return [
+        [{'id': member, 'name': member} if isinstance(member, str) else member for member in team]
+        for team in teams
+    ]
+
+def anonymize_teams(teams):
+    """Same teams with members named by their place in the team"""
+    return [
+        [{'id': member.get('id', f'user_{j}'), 'name': f'Member {j+1}'} for j, member in enumerate(team)]
+        for team in teams
+    ]
+
+def store_teams(session_id, teams):
+    """Store formatted teams together with their anonymized variant and announce them"""
+    storage.set_teams(session_id, teams, anonymize_teams(teams))
+    publish_event(session_id, 'teams', teams=len(teams))
+
+def optimization_summary(result):
+    return {
+        'optimizer': result['optimizer'],
+        'objective': result['objective'],
+        'iterations': result.get('iterations', 0),
+        'elapsed': result.get('elapsed', 0),
+        'constraints': result.get('constraints'),
+        # Passed back as seed and max_iterations, these reproduce the teams
+        'seed': result.get('seed'),
+        'max_iterations': result.get('max_iterations'),
+        # The time budget stopped the search before max_iterations
+        'timed_out': result.get('timed_out', False),
+        'restarts': result.get('restarts')
+    }
+
 @app.route("/api/session/<session_id>/teams", methods=["POST"])
 def generate_teams(session_id):
     try:
-        session_data = get_session_data(session_id)
+        session_data = storage.get_session(session_id)
         if not session_data:
             return jsonify({'error': 'Session not found'}), 404
         
         surveys = session_data.get('surveys', [])
         if not surveys:
             return jsonify({'error': 'No surveys submitted'}), 400
+        observe_surveys(len(surveys))
         
         # Get settings from request body if provided, otherwise use session settings
         request_settings = request.json.get('settings', {}) if request.json else {}
+        if not isinstance(request_settings, dict):
+            return jsonify({'error': 'settings must be an object'}), 400
         settings = session_data.get('settings', {})
         settings.update(request_settings)  # Update with any provided settings
+        try:
+            check_settings(settings)
+        except SettingsError as e:
+            return jsonify({'error': str(e)}), 400
+        options = team_options(settings)
+        restarts = team_restarts(settings)
         
-        team_size = int(settings.get('team_size', 4))
-        team_approach = settings.get('team_approach', 'homogeni')
-        characteristics = settings.get('characteristics', ["tech_skills", "comm_skills", "creative_skills", "leadership_skills"])
-        similarity_threshold = float(settings.get('similarity_threshold', 50))
+        log_event(logger, logging.DEBUG, "generating teams", session_id=session_id, surveys=len(surveys),
+                  restarts=restarts, **{k: v for k, v in options.items() if k != 'characteristics'})
         
-        print(f"Generating teams with settings:")
-        print(f"- Team size: {team_size}")
-        print(f"- Team approach: {team_approach}")
-        print(f"- Characteristics: {characteristics}")
-        print(f"- Similarity threshold: {similarity_threshold}")
-        print(f"Number of surveys: {len(surveys)}")
+        # Same surveys and settings as an earlier run: reuse its teams unless a refresh is asked for
+        with stage('cache'):
+            cache_key = result_key(session_id, surveys, dict(options, restarts=restarts))
+            cached = None if request.args.get('refresh') in ('1', 'true') else result_cache.get(cache_key)
+        if cached is not None:
+            log_event(logger, logging.INFO, "teams served from cache", session_id=session_id, surveys=len(surveys))
+            session_data['teams'] = cached['teams']
+            with stage('store'):
+                store_teams(session_id, cached['teams'])
+            if request.args.get('async') in ('1', 'true'):
+                # Still answered as a job, one that is done already
+                job_id = completed_team_job(storage, session_id, dict(cached, cached=True))
+                return jsonify({'job_id': job_id, 'status': 'done'}), 202
+            return jsonify(dict(session_data, optimization=cached['optimization'],
+                                metrics=cached.get('metrics'), cached=True))
         
-        # Create DataFrame with survey data
-        df = pd.DataFrame(surveys)
-        print(f"Survey data shape: {df.shape}")
-        print(f"Survey data columns: {df.columns.tolist()}")
+        # Only surveys submitted since the last call are added to the cached features; the
+        # snapshot is unaffected by submissions that come in while the teams are generated
+        with stage('features'):
+            session_features = get_feature_store().sync(session_id, options['characteristics'], surveys,
+                                                  memory_limit=min(options['memory_limit_mb'], FEATURE_CACHE_MB) * 1024 * 1024)
+        
+        if request.args.get('async') in ('1', 'true'):
+            # Run in the process pool; the client polls the job for the result
+            positions = session_features.positions
+            def finish(result):
+                formatted_teams = format_teams(result['teams'], surveys, positions)
+                store_teams(session_id, formatted_teams)
+                output = {'teams': formatted_teams, 'optimization': optimization_summary(result),
+                          'metrics': result['metrics']}
+                result_cache.set(cache_key, output)
+                return output
+            
+            job_id = submit_team_job(storage, session_id, surveys, options,
+                                     features=session_features.features, on_done=finish, restarts=restarts)
+            return jsonify({'job_id': job_id, 'status': 'queued'}), 202
         
         # Generate teams
-        teams = make_teams(
-            users=surveys,  # Pass the raw survey data
-            team_size=team_size,
-            team_approach=team_approach,
-            characteristics=characteristics,
-            similarity_threshold=similarity_threshold
-        )
+        result = generate(surveys, session_features, options, restarts)
+        teams = result['teams']
+        for name, seconds in result['timings'].items():
+            observe_stage(name, seconds)
         
         if not teams:
             return jsonify({'error': 'Failed to generate teams'}), 500
             
         # Format teams with member details
-        formatted_teams = []
-        for team in teams:
-            team_members = []
-            for member_id in team:
-                member_data = next((s for s in surveys if s.get('id') == member_id), None)
-                if member_data:
-                    team_members.append({
-                        'id': member_id,
-                        'name': member_data.get('name', member_id)
-                    })
-            if team_members:  # Only add teams that have members
-                formatted_teams.append(team_members)
+        with stage('format'):
+            formatted_teams = format_teams(teams, surveys, session_features.positions)
             
-        print(f"Generated teams: {json.dumps(formatted_teams, indent=2)}")
-        
         session_data['teams'] = formatted_teams
-        set_session(session_id, session_data)
-        return jsonify(session_data)
+        with stage('store'):
+            store_teams(session_id, formatted_teams)
+        optimization = optimization_summary(result)
+        result_cache.set(cache_key, {'teams': formatted_teams, 'optimization': optimization,
+                                     'metrics': result['metrics']})
+        return jsonify(dict(session_data, optimization=optimization, metrics=result['metrics'], cached=False))
+    except RedisError:
+        # Answered with 503 by storage_unavailable
+        raise
     except Exception as e:
-        print(f"Error generating teams: {str(e)}")
-        print("Full error:", traceback.format_exc())
+        logger.exception("error generating teams for session %s", session_id)
         return jsonify({'error': str(e)}), 500
 
+def regenerate_sessions(session_ids, overrides=None):
+    """Regenerate the teams of several sessions at once, across all cores
+
+    The sessions are read in one pipelined pass and generated in the job
+    process pool with their feature matrices in shared memory; the teams of
+    all of them are then written back in one pipelined pass. overrides are
+    settings applied to every session for this run only, like the settings
+    of a single generation request. Returns a summary per session id.
+    """
+    from similarity import build_feature_matrix
+    from team_logic import best_result
+    start = time.perf_counter()
+    summary = {}
+    batch, tasks = [], []
+    with stage('redis'):
+        sessions = storage.get_sessions(session_ids)
+    for session_id, session_data in sessions.items():
+        if session_data is None:
+            summary[session_id] = {'error': 'Session not found'}
+            continue
+        surveys = session_data['surveys']
+        if not surveys:
+            summary[session_id] = {'error': 'No surveys submitted'}
+            continue
+        settings = dict(session_data['settings'], **(overrides or {}))
+        try:
+            check_settings(settings)
+        except SettingsError as e:
+            summary[session_id] = {'error': str(e)}
+            continue
+        options = team_options(settings)
+        # Features this worker already holds are reused, the rest are built in one pass each
+        features = None
+        if feature_store is not None:
+            features = feature_store.cached_features(session_id, options['characteristics'], surveys)
+        if features is None:
+            features = build_feature_matrix(surveys, options['characteristics'])
+        for run in restart_options(options, team_restarts(settings)):
+            batch.append(session_id)
+            tasks.append((surveys, features, run))
+    
+    # Runs grouped by session; a session fails only if all of its runs failed
+    outcomes = run_team_batch(storage, tasks) if tasks else []
+    runs = {}
+    for session_id, (surveys, _, options), outcome in zip(batch, tasks, outcomes):
+        runs.setdefault(session_id, (surveys, options, []))[2].append(outcome)
+    written = {}
+    for session_id, (surveys, options, outcomes) in runs.items():
+        results = [result for result, error in outcomes if error is None]
+        if not results:
+            logger.error("batch generation failed for session %s: %s", session_id, outcomes[0][1])
+            summary[session_id] = {'error': str(outcomes[0][1])}
+            continue
+        result = results[0] if len(outcomes) == 1 else best_result(results, options['team_approach'])
+        formatted_teams = format_teams(result['teams'], surveys)
+        written[session_id] = (formatted_teams, anonymize_teams(formatted_teams))
+        summary[session_id] = {'teams': len(formatted_teams), 'optimization': optimization_summary(result)}
+    if written:
+        with stage('store'):
+            storage.set_teams_many(written)
+    for session_id, (formatted_teams, _) in written.items():
+        result_cache.invalidate(session_id)
+        publish_event(session_id, 'teams', teams=len(formatted_teams))
+    log_event(logger, logging.INFO, "sessions regenerated", sessions=len(session_ids), generated=len(written),
+              failed=len(session_ids) - len(written), seconds=time.perf_counter() - start)
+    return summary
+
+@app.route("/api/admin/regenerate", methods=["POST"])
+def regenerate_route():
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Admin routes are disabled'}), 403
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {ADMIN_TOKEN}'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    data = request.get_json(silent=True) or {}
+    session_ids = data.get('session_ids')
+    if not isinstance(session_ids, list) or not session_ids:
+        return jsonify({'error': 'session_ids must be a non-empty list'}), 400
+    session_ids = list(dict.fromkeys(str(session_id) for session_id in session_ids))
+    overrides = data.get('settings') or {}
+    if not isinstance(overrides, dict):
+        return jsonify({'error': 'settings must be an object'}), 400
+    # The overrides alone, over the defaults; each session's own settings are checked with them
+    try:
+        check_settings(overrides)
+    except SettingsError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'sessions': regenerate_sessions(session_ids, overrides)})
+
+@app.route("/api/session/<session_id>/teams/jobs/<job_id>", methods=["GET"])
+def get_team_job(session_id, job_id):
+    job = storage.get_job(job_id)
+    if not job or job.get('session_id') != session_id:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
 @app.route("/api/session/<session_id>/settings", methods=["GET", "PUT", "POST"])
 def handle_settings(session_id):
     if request.method == "GET":
-        session_data = get_redis_key(f'session:{session_id}')
-        if not session_data:
+        settings = storage.get_settings(session_id)
+        if settings is None:
             return jsonify({"error": "Session not found"}), 404
         
-        session_data = json.loads(session_data)
-        return jsonify(session_data.get("settings", {})), 200
+        return jsonify(settings), 200
     
     elif request.method in ["PUT", "POST"]:
+        from optimizer import DEFAULT_TIME_BUDGET
         data = request.json
-        session_data = get_redis_key(f'session:{session_id}')
-        if not session_data:
+        settings = storage.get_settings(session_id)
+        if settings is None:
             return jsonify({'error': 'Session not found'}), 404
         
-        session_data = json.loads(session_data)
-        session_data['settings'].update({
+        # The frontend's settings form only sends the first six; the rest keep their
+        # saved value unless given
+        tuning = {key: data[key] if key in data else settings.get(key, default) for key, default in (
+            ('optimizer', 'annealing'),
+            ('time_budget', DEFAULT_TIME_BUDGET),
+            ('similarity_mode', 'auto'),
+            ('grouping', 'knn'),
+            ('memory_limit_mb', DEFAULT_MEMORY_LIMIT_MB),
+            ('constraints', None),
+            ('seed', None),
+            ('restarts', 1),
+            ('max_iterations', None)
+        )}
+        settings.update({
             'anonymous_mode': data.get('anonymous_mode', False),
             'show_teams_to_users': data.get('show_teams_to_users', True),
             'team_size': data.get('team_size', 4),
             'team_approach': data.get('team_approach', 'homogeni'),
-            'characteristics': data.get('characteristics', ["tech_skills", "comm_skills", "creative_skills", "leadership_skills"]),
+            'characteristics': data.get('characteristics', DEFAULT_CHARACTERISTICS),
             'similarity_threshold': data.get('similarity_threshold', 50)
         })
-        set_redis_key(f'session:{session_id}', json.dumps(session_data))
-        return jsonify(session_data)
+        settings.update(tuning)
+        # Checked here, so a bad value fails the save rather than every later generation
+        try:
+            check_settings(settings)
+        except SettingsError as e:
+            return jsonify({'error': str(e)}), 400
+        storage.set_settings(session_id, settings)
+        result_cache.invalidate(session_id)
+        publish_event(session_id, 'settings', settings=settings)
+        return jsonify(storage.get_session(session_id))
 
 @app.route("/api/session/<sid>/surveys", methods=["GET"])
 def get_surveys(sid):
-    session_data = get_redis_key(f'session:{sid}')
-    if not session_data:
+    surveys = storage.get_surveys(sid)
+    if surveys is None:
         return jsonify({"error": "Session not found"}), 404
     
-    session_data = json.loads(session_data)
-    return jsonify(session_data.get("surveys", [])), 200
+    return jsonify(surveys), 200
 
 @app.route("/api/session/<session_id>/teams", methods=["GET"])
 def get_teams(session_id):
     try:
-        # Use get_redis_key helper instead of direct redis_client access
-        session_data = get_redis_key(f'session:{session_id}')
-        if not session_data:
+        settings = storage.get_settings(session_id)
+        if settings is None:
             return jsonify({'error': 'Session not found'}), 404
-            
-        # Parse JSON if it's a string
-        if isinstance(session_data, str):
-            try:
-                session_data = json.loads(session_data)
-            except json.JSONDecodeError:
-                return jsonify({'error': 'Invalid session data format'}), 500
-                
-        # Get teams and settings
-        teams = session_data.get('teams', [])
-        settings = session_data.get('settings', {})
         anonymous_mode = settings.get('anonymous_mode', False)
         
-        # Format team member names based on anonymous mode
-        formatted_teams = []
-        for i, team in enumerate(teams):
-            formatted_team = []
-            for j, member in enumerate(team):
-                # Handle case where member might be a string
-                if isinstance(member, str):
-                    member_id = member
-                    member_name = f'Member {j+1}' if anonymous_mode else member
-                    formatted_team.append({
-                        'id': member_id,
-                        'name': member_name
-                    })
-                else:
-                    # Handle case where member is a dictionary
-                    if anonymous_mode:
-                        formatted_team.append({
-                            'id': member.get('id', f'user_{j}'),
-                            'name': f'Member {j+1}'
-                        })
-                    else:
-                        formatted_team.append(member)
-            formatted_teams.append(formatted_team)
-            
-        return jsonify(formatted_teams)
-    except Exception as e:
-        print(f"Error in get_teams: {str(e)}")
-        print("Full error:", traceback.format_exc())
+        # Teams are stored display-ready in both variants, so they are served as stored
+        with stage('redis'):
+            teams_json = storage.get_teams_json(session_id, anonymous=anonymous_mode)
+        if teams_json is None:
+            # Teams stored before the variants were kept: derive them once
+            teams = display_teams(storage.get_teams(session_id) or [])
+            storage.set_teams(session_id, teams, anonymize_teams(teams))
+            teams_json = storage.get_teams_json(session_id, anonymous=anonymous_mode)
+        return Response(teams_json, mimetype='application/json')
+    except RedisError:
+        # Answered with 503 by storage_unavailable
+        raise
+    except Exception:
+        logger.exception("error reading teams of session %s", session_id)
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route("/api/session/<session_id>/events", methods=["GET"])
+def session_events(session_id):
+    """Server-sent events with the session's updates
+
+    Starts with a snapshot (survey count, settings, whether teams exist),
+    then sends survey, surveys (bulk import), settings and teams events as
+    they happen, with a comment line as keepalive. The stream ends after
+    EVENT_STREAM_SECONDS; EventSource reconnects and gets a fresh snapshot.
+    """
+    settings = storage.get_settings(session_id)
+    if settings is None:
+        return jsonify({'error': 'Session not found'}), 404
+    # Each stream holds a thread; past the cap the client falls back to polling
+    if not event_stream_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many event streams, poll instead'}), 503
+    try:
+        # Subscribe before reading the snapshot, so no update falls in between
+        subscription = broadcaster.subscribe(session_id)
+        snapshot = {
+            'type': 'snapshot',
+            'survey_count': storage.survey_count(session_id),
+            'settings': settings,
+            'teams': storage.get_teams_json(session_id) not in (None, '[]')
+        }
+    except Exception:
+        event_stream_slots.release()
+        raise
+    
+    def stream():
+        yield f"retry: {EVENT_RETRY_MS}\n" + format_event(snapshot)
+        deadline = time.monotonic() + EVENT_STREAM_SECONDS
+        while time.monotonic() < deadline:
+            event = subscription.get(timeout=min(EVENT_KEEPALIVE_SECONDS, deadline - time.monotonic()))
+            yield format_event(event) if event is not None else ": keepalive\n\n"
+    
+    def close():
+        subscription.close()
+        event_stream_slots.release()
+    
+    response = Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Tell proxies not to buffer the stream
+        'X-Accel-Buffering': 'no'
+    })
+    # Also run when the client left before the stream started
+    response.call_on_close(close)
+    return response
+
 # Debug route to check application status
 @app.route('/debug')
 def debug():
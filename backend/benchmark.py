@@ -0,0 +1,169 @@
+# backend/benchmark.py
+"""Benchmark team_logic on synthetic survey populations
+
+Usage:
+    python benchmark.py --sizes 10,100,1000 --characteristics 4,20 --output results.json
+
+For every population size N and number of characteristics k it times the
+similarity-matrix build, make_teams for each approach and scoring of the
+generated teams, both team by team with calculate_team_metrics and in one
+batch with score_teams, and reports wall time,
+peak traced memory and team quality (mean THI) as JSON. Populations are
+generated from --seed, which also seeds the search. With --max-iterations
+the search does not depend on the clock either, so results repeat exactly.
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import logging
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from similarity import build_feature_matrix, similarity_matrix
+from team_logic import make_teams, calculate_team_metrics, score_teams
+from optimizer import labels_from_teams
+
+DEFAULT_SIZES = (10, 100, 1000, 5000, 10000, 20000)
+DEFAULT_CHARACTERISTICS = (4, 8, 20)
+APPROACHES = ('homogeni', 'heterogeni')
+
+def synthetic_surveys(num_users, num_characteristics, seed):
+    """Surveys with integer scores from 1 to 5, like the survey form produces"""
+    rng = np.random.default_rng(seed)
+    characteristics = [f'char_{i}' for i in range(num_characteristics)]
+    scores = rng.integers(1, 6, size=(num_users, num_characteristics))
+    users = [
+        dict(zip(characteristics, row), id=f'user_{i}', name=f'User {i}')
+        for i, row in enumerate(scores.tolist())
+    ]
+    return users, characteristics
+
+def measure(fn, trace_memory=True):
+    """Time fn, then run it again under tracemalloc for its peak memory
+
+    Tracing slows allocations down, so time and memory come from separate
+    runs. Returns the result of the timed run, wall seconds and peak traced
+    bytes (None without trace_memory).
+    """
+    gc.collect()
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return result, seconds, peak
+
+def run_case(num_users, num_characteristics, args):
+    users, characteristics = synthetic_surveys(num_users, num_characteristics, args.seed)
+    case = {'n': num_users, 'k': num_characteristics, 'team_size': args.team_size}
+
+    def build_matrix():
+        return similarity_matrix(build_feature_matrix(users, characteristics))
+
+    _, seconds, peak = measure(build_matrix, args.memory)
+    case['similarity_matrix'] = {'seconds': seconds, 'peak_bytes': peak}
+
+    users_by_id = {user['id']: user for user in users}
+    for approach in APPROACHES:
+        result, seconds, peak = measure(lambda: make_teams(
+            users, args.team_size, approach, characteristics, args.similarity_threshold,
+            optimizer=args.optimizer, time_budget=args.time_budget, max_iterations=args.max_iterations,
+            return_details=True, seed=args.seed
+        ), args.memory)
+        case[approach] = {
+            'seconds': seconds,
+            'peak_bytes': peak,
+            'teams': len(result['teams']),
+            'objective': result['objective'],
+            'initial_objective': result.get('initial_objective', result['objective']),
+            'iterations': result.get('iterations', 0),
+            'timings': result.get('timings', {})
+        }
+
+        team_records = [[users_by_id[member] for member in team] for team in result['teams']]
+        metrics, seconds, peak = measure(lambda: [
+            calculate_team_metrics(team, characteristics) for team in team_records
+        ], args.memory)
+        case[approach]['team_metrics'] = {
+            'seconds': seconds,
+            'peak_bytes': peak,
+            'mean_thi': float(np.mean([m['thi'] for m in metrics])) if metrics else 0.0
+        }
+
+        index = {user['id']: i for i, user in enumerate(users)}
+        labels = labels_from_teams([[index[member] for member in team] for team in result['teams']], len(users))
+        features = build_feature_matrix(users, characteristics)
+        scores, seconds, peak = measure(lambda: score_teams(features, labels, characteristics), args.memory)
+        case[approach]['batch_scoring'] = {
+            'seconds': seconds,
+            'peak_bytes': peak,
+            'mean_thi': scores['session']['thi']
+        }
+    return case
+
+def parse_list(text):
+    return [int(value) for value in text.split(',') if value]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=parse_list, default=list(DEFAULT_SIZES),
+                        help='comma-separated population sizes N')
+    parser.add_argument('--characteristics', type=parse_list, default=list(DEFAULT_CHARACTERISTICS),
+                        help='comma-separated numbers of characteristics k')
+    parser.add_argument('--team-size', type=int, default=4)
+    parser.add_argument('--similarity-threshold', type=float, default=50)
+    parser.add_argument('--optimizer', default='annealing', help="optimizer name, or 'none'")
+    parser.add_argument('--time-budget', type=float, default=1.0)
+    parser.add_argument('--max-iterations', type=int,
+                        help='bound the search by swap attempts instead of the time budget')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the synthetic populations and the search')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the second, memory-traced run of each step')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+    if args.optimizer == 'none':
+        args.optimizer = None
+
+    # Keep the per-call summary lines out of the measurements
+    logging.getLogger('team_sync').setLevel(logging.WARNING)
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count()
+        },
+        'settings': {key: value for key, value in vars(args).items() if key != 'output'},
+        'cases': []
+    }
+    for num_users in args.sizes:
+        for num_characteristics in args.characteristics:
+            case = run_case(num_users, num_characteristics, args)
+            report['cases'].append(case)
+            print(f"n={num_users} k={num_characteristics} done", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
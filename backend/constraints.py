@@ -0,0 +1,424 @@
+# backend/constraints.py
+"""Constraints on team assignments
+
+A constraints spec (the session setting 'constraints') may contain:
+
+    must_pair       groups of user ids that must share a team
+    must_separate   groups of user ids that must all be in different teams
+    min_per_team    [{'characteristic': 'leadership_skills', 'min_value': 4, 'count': 1}]
+                    at least count members per team scoring min_value or more
+    balanced_sizes  true for team sizes that differ by at most one, instead of
+                    full teams plus one smaller team for the remainder
+
+Groups are lists of ids, or {'members': [...], 'hard': false}; min_per_team
+entries take 'hard' too. Hard constraints (the default) are never broken by
+the optimizer once they hold; soft ones cost a penalty per violation. A hard
+constraint that cannot be met is relaxed to a soft one and reported.
+"""
+
+import numpy as np
+
+CONSTRAINT_KINDS = ('must_pair', 'must_separate', 'min_per_team')
+# Penalty per violated hard constraint unit, in mean-THI units: large enough
+# that fixing one always outweighs the objective
+HARD_WEIGHT = 1000.0
+# Candidate partners tried per repair move
+REPAIR_CANDIDATES = 64
+# Passes over the violated constraints while repairing the starting assignment
+REPAIR_PASSES = 4
+
+class _Group:
+    """must_pair or must_separate group with its members counted per team"""
+
+    def __init__(self, kind, index, members, hard):
+        self.kind = kind
+        self.index = index
+        self.members = members
+        self.hard = hard
+        self.relaxed = None
+        self.counts = {}
+
+    def violations(self):
+        if self.kind == 'must_pair':
+            # Teams spanned beyond the first
+            return len(self.counts) - 1
+        # Members sharing a team with another member
+        return len(self.members) - len(self.counts)
+
+    def moved_violations(self, changes):
+        """Violations after adding changes (team -> count change) to the counts"""
+        spanned = len(self.counts)
+        for team, change in changes.items():
+            before = self.counts.get(team, 0)
+            after = before + change
+            spanned += (after > 0) - (before > 0)
+        if self.kind == 'must_pair':
+            return spanned - 1
+        return len(self.members) - spanned
+
+class _Quota:
+    """min_per_team entry: qualifying members counted per team"""
+
+    def __init__(self, index, qualifies, count, hard, num_teams):
+        self.kind = 'min_per_team'
+        self.index = index
+        self.qualifies = qualifies
+        self.count = count
+        self.hard = hard
+        self.relaxed = None
+        self.per_team = np.zeros(num_teams, dtype=np.int64)
+
+    def violations(self):
+        return int(np.maximum(self.count - self.per_team, 0).sum())
+
+class ConstraintError(ValueError):
+    """A constraints spec that cannot be used"""
+
+def _check_group(kind, entry):
+    if isinstance(entry, dict):
+        members, hard = entry.get('members'), entry.get('hard', True)
+    else:
+        members, hard = entry, True
+    if not isinstance(members, list):
+        raise ConstraintError(f"{kind} groups must be lists of ids or objects with members")
+    if any(isinstance(member, bool) or not isinstance(member, (str, int)) for member in members):
+        raise ConstraintError(f"{kind} members must be survey ids")
+    if not isinstance(hard, bool):
+        raise ConstraintError(f"{kind} hard must be true or false")
+    return members if hard else {'members': members, 'hard': False}
+
+def _check_quota(entry):
+    if not isinstance(entry, dict):
+        raise ConstraintError("min_per_team entries must be objects")
+    characteristic = entry.get('characteristic')
+    if not isinstance(characteristic, str) or not characteristic:
+        raise ConstraintError("min_per_team characteristic must be a name")
+    min_value, count, hard = entry.get('min_value', 0), entry.get('count', 1), entry.get('hard', True)
+    if isinstance(min_value, bool) or not isinstance(min_value, (int, float)):
+        raise ConstraintError("min_per_team min_value must be a number")
+    if isinstance(count, bool) or not isinstance(count, int) or count < 0:
+        raise ConstraintError("min_per_team count must be a non-negative integer")
+    if not isinstance(hard, bool):
+        raise ConstraintError("min_per_team hard must be true or false")
+    return {'characteristic': characteristic, 'min_value': min_value, 'count': count, 'hard': hard}
+
+def validate_constraints(spec):
+    """Checked copy of a constraints spec (None for none); raises ConstraintError"""
+    if spec is None:
+        return None
+    if not isinstance(spec, dict):
+        raise ConstraintError("constraints must be an object")
+    for key in spec:
+        if key not in CONSTRAINT_KINDS and key != 'balanced_sizes':
+            raise ConstraintError(f"unknown constraint: {key}")
+    checked = {}
+    for kind in CONSTRAINT_KINDS:
+        entries = spec.get(kind)
+        if entries is None:
+            continue
+        if not isinstance(entries, list):
+            raise ConstraintError(f"{kind} must be a list")
+        if kind == 'min_per_team':
+            checked[kind] = [_check_quota(entry) for entry in entries]
+        else:
+            checked[kind] = [_check_group(kind, entry) for entry in entries]
+    if 'balanced_sizes' in spec:
+        if not isinstance(spec['balanced_sizes'], bool):
+            raise ConstraintError("balanced_sizes must be true or false")
+        checked['balanced_sizes'] = spec['balanced_sizes']
+    return checked
+
+def _parse_group(entry):
+    if isinstance(entry, dict):
+        return entry.get('members', []), entry.get('hard', True)
+    return entry, True
+
+class ConstraintSet:
+    """Constraints bound to one set of users, tracking their violations incrementally
+
+    Swap candidates are checked in time proportional to the constraints the
+    two users take part in, so unconstrained users cost one lookup.
+    """
+
+    def __init__(self, spec, users, labels, soft_weight=1.0):
+        labels = np.asarray(labels, dtype=np.int64)
+        self.num_teams = int(labels.max()) + 1 if len(labels) else 0
+        # Soft penalty per violation: as much as one team's THI changing by soft_weight
+        self.soft_penalty = soft_weight / max(self.num_teams, 1)
+        sizes = np.bincount(labels, minlength=self.num_teams).tolist()
+
+        index_of = {}
+        for i, user in enumerate(users):
+            index_of.setdefault(str(user.get('id', i)), i)
+        self.unknown_ids = 0
+
+        def indices(ids):
+            found = []
+            for user_id in ids:
+                i = index_of.get(str(user_id))
+                if i is None:
+                    self.unknown_ids += 1
+                elif i not in found:
+                    found.append(i)
+            return found
+
+        self.constraints = []
+        # Overlapping must_pair groups are one group: merge them with a union-find
+        parent = {}
+
+        def root(i):
+            while parent.setdefault(i, i) != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        pair_groups = {}
+        for index, entry in enumerate(spec.get('must_pair') or []):
+            ids, hard = _parse_group(entry)
+            found = indices(ids)
+            for i in found[1:]:
+                parent[root(i)] = root(found[0])
+            if len(found) > 1:
+                pair_groups.setdefault(root(found[0]), []).append((index, hard))
+        components = {}
+        for i in parent:
+            components.setdefault(root(i), []).append(i)
+        for key, entries in pair_groups.items():
+            group = _Group('must_pair', entries[0][0], sorted(components[root(key)]),
+                           all(hard for _, hard in entries))
+            if len(group.members) > max(sizes, default=0):
+                group.relaxed = 'group is larger than a team'
+            self.constraints.append(group)
+
+        for index, entry in enumerate(spec.get('must_separate') or []):
+            ids, hard = _parse_group(entry)
+            found = indices(ids)
+            if len(found) < 2:
+                continue
+            group = _Group('must_separate', index, found, hard)
+            # Two members that must also share a team cannot be separated
+            paired = [root(i) for i in found if i in parent]
+            if len(found) > self.num_teams:
+                group.relaxed = 'more members than teams'
+            elif len(set(paired)) < len(paired):
+                group.relaxed = 'conflicts with must_pair'
+            self.constraints.append(group)
+
+        for index, entry in enumerate(spec.get('min_per_team') or []):
+            char = entry.get('characteristic')
+            if not char:
+                continue
+            values = np.array([_score(user.get(char)) for user in users], dtype=np.float64)
+            quota = _Quota(index, values >= float(entry.get('min_value', 0)), int(entry.get('count', 1)),
+                           entry.get('hard', True), self.num_teams)
+            if int(quota.qualifies.sum()) < quota.count * self.num_teams:
+                quota.relaxed = 'not enough qualifying users'
+            self.constraints.append(quota)
+
+        # Constraints each user takes part in
+        self.groups_of = {}
+        for constraint in self.constraints:
+            if isinstance(constraint, _Group):
+                for i in constraint.members:
+                    self.groups_of.setdefault(i, []).append(constraint)
+        self.quotas = [c for c in self.constraints if isinstance(c, _Quota)]
+        self.reset(labels)
+
+    def reset(self, labels):
+        """Count the violations of a new assignment from scratch"""
+        self.labels = np.array(labels, dtype=np.int64)
+        self.members = [[] for _ in range(self.num_teams)]
+        for user, team in enumerate(self.labels.tolist()):
+            self.members[team].append(user)
+        self.position = np.empty(len(self.labels), dtype=np.int64)
+        for team in self.members:
+            self.position[team] = np.arange(len(team))
+        for constraint in self.constraints:
+            if isinstance(constraint, _Group):
+                constraint.counts = {}
+                for i in constraint.members:
+                    constraint.counts[self.labels[i]] = constraint.counts.get(self.labels[i], 0) + 1
+            else:
+                constraint.per_team[:] = 0
+                np.add.at(constraint.per_team, self.labels[constraint.qualifies], 1)
+        self.hard_violations, self.soft_violations = self._totals()
+
+    def __bool__(self):
+        return bool(self.constraints)
+
+    def is_hard(self, constraint):
+        return constraint.hard and constraint.relaxed is None
+
+    def _totals(self):
+        hard = soft = 0
+        for constraint in self.constraints:
+            if self.is_hard(constraint):
+                hard += constraint.violations()
+            else:
+                soft += constraint.violations()
+        return hard, soft
+
+    def _change(self, constraint, a, b):
+        """Change of one constraint's violations if users a and b swap teams"""
+        team_a, team_b = self.labels[a], self.labels[b]
+        if constraint.kind == 'min_per_team':
+            if constraint.qualifies[a] == constraint.qualifies[b]:
+                return 0
+            # The qualifying one of the two changes teams
+            src, dst = (team_a, team_b) if constraint.qualifies[a] else (team_b, team_a)
+            return int(constraint.per_team[src] <= constraint.count) - int(constraint.per_team[dst] < constraint.count)
+        # a moves to team_b, b to team_a; a member of both cancels out
+        changes = {team_a: 0, team_b: 0}
+        if constraint in self.groups_of.get(a, ()):
+            changes[team_a] -= 1
+            changes[team_b] += 1
+        if constraint in self.groups_of.get(b, ()):
+            changes[team_b] -= 1
+            changes[team_a] += 1
+        return constraint.moved_violations(changes) - constraint.violations()
+
+    def swap_delta(self, a, b):
+        """Change of (hard, soft) violations if users a and b swap teams"""
+        hard = soft = 0
+        groups_a = self.groups_of.get(a, ())
+        groups_b = self.groups_of.get(b, ())
+        involved = set(groups_a) | set(groups_b) if groups_a or groups_b else ()
+        for constraint in (*involved, *self.quotas):
+            change = self._change(constraint, a, b)
+            if self.is_hard(constraint):
+                hard += change
+            else:
+                soft += change
+        return hard, soft
+
+    def penalty(self, hard, soft):
+        """Objective units lost for the given violation changes"""
+        return hard * HARD_WEIGHT + soft * self.soft_penalty
+
+    def apply_swap(self, a, b, hard=None, soft=None):
+        """Swap users a and b between their teams, given their swap_delta if known"""
+        if hard is None:
+            hard, soft = self.swap_delta(a, b)
+        team_a, team_b = self.labels[a], self.labels[b]
+        for user, src, dst in ((a, team_a, team_b), (b, team_b, team_a)):
+            for group in self.groups_of.get(user, ()):
+                group.counts[src] -= 1
+                if not group.counts[src]:
+                    del group.counts[src]
+                group.counts[dst] = group.counts.get(dst, 0) + 1
+            for quota in self.quotas:
+                if quota.qualifies[user]:
+                    quota.per_team[src] -= 1
+                    quota.per_team[dst] += 1
+        pos_a, pos_b = self.position[a], self.position[b]
+        self.members[team_a][pos_a] = b
+        self.members[team_b][pos_b] = a
+        self.position[a], self.position[b] = pos_b, pos_a
+        self.labels[a], self.labels[b] = team_b, team_a
+        self.hard_violations += hard
+        self.soft_violations += soft
+
+    def _best_swap(self, user, candidates, constraint):
+        """Swap of user with one of candidates that lowers the penalty most, or None
+
+        Without such a swap, one that keeps the penalty but takes a violation
+        off constraint is used, so that the violation can be fixed where it
+        lands (e.g. a team's only leader leaving to join its pair).
+        """
+        best, best_key = None, (0.0, 0)
+        for other in candidates:
+            if self.labels[other] == self.labels[user]:
+                continue
+            hard, soft = self.swap_delta(user, other)
+            penalty = self.penalty(hard, soft)
+            if penalty > 0:
+                continue
+            key = (penalty, self._change(constraint, user, other))
+            if key < best_key:
+                best, best_key = (other, hard, soft), key
+        return best
+
+    def _sample(self, pool, rng):
+        pool = np.asarray(pool)
+        if len(pool) > REPAIR_CANDIDATES:
+            pool = rng.choice(pool, REPAIR_CANDIDATES, replace=False)
+        return pool.tolist()
+
+    def repair(self, rng=None):
+        """Targeted swaps that remove violations, hard ones first; returns the labels
+
+        Random swaps rarely bring two given users together among thousands,
+        so each violated constraint proposes swaps that move its own members.
+        """
+        rng = rng if rng is not None else np.random.default_rng()
+        for _ in range(REPAIR_PASSES):
+            if not self.hard_violations and not self.soft_violations:
+                break
+            ordered = sorted(self.constraints, key=lambda c: not self.is_hard(c))
+            for constraint in ordered:
+                if not constraint.violations():
+                    continue
+                for user, candidates in self._proposals(constraint, rng):
+                    move = self._best_swap(user, candidates, constraint)
+                    if move is not None:
+                        self.apply_swap(user, *move)
+        return self.labels
+
+    def _proposals(self, constraint, rng):
+        """(user, candidate partners) pairs for swaps that may reduce the constraint's violations"""
+        if constraint.kind == 'must_pair':
+            # Gather the group in the team already holding most of it
+            target = max(constraint.counts, key=constraint.counts.get)
+            partners = [i for i in self.members[target] if i not in constraint.members]
+            for user in constraint.members:
+                if self.labels[user] != target:
+                    yield user, self._sample(partners, rng)
+        elif constraint.kind == 'must_separate':
+            # Move members that share a team to teams with no member yet
+            free = [t for t in range(self.num_teams) if t not in constraint.counts]
+            seen = set()
+            for user in constraint.members:
+                team = self.labels[user]
+                if team in seen:
+                    pool = [i for t in self._sample(free, rng) for i in self.members[t]]
+                    yield user, self._sample(pool, rng)
+                seen.add(team)
+        else:
+            short = np.flatnonzero(constraint.per_team < constraint.count)
+            spare = np.flatnonzero(constraint.per_team > constraint.count)
+            donors = [i for t in self._sample(spare, rng) for i in self.members[t] if constraint.qualifies[i]]
+            for team in short.tolist():
+                for user in list(self.members[team]):
+                    if constraint.per_team[team] >= constraint.count:
+                        break
+                    if not constraint.qualifies[user]:
+                        yield user, self._sample(donors, rng)
+
+    def relax_unmet(self):
+        """Relax the hard constraints still violated, e.g. when the budget ran out"""
+        for constraint in self.constraints:
+            if self.is_hard(constraint) and constraint.violations():
+                constraint.relaxed = 'could not be satisfied'
+        self.hard_violations, self.soft_violations = self._totals()
+
+    def report(self):
+        """Per-constraint outcome, and the hard constraints that were relaxed"""
+        constraints = [{
+            'kind': constraint.kind,
+            'index': constraint.index,
+            'hard': bool(constraint.hard),
+            'violations': constraint.violations(),
+            'relaxed': constraint.relaxed
+        } for constraint in self.constraints]
+        return {
+            'constraints': constraints,
+            'relaxed': [c for c in constraints if c['relaxed']],
+            'violations': sum(c['violations'] for c in constraints),
+            'unknown_ids': self.unknown_ids
+        }
+
+def _score(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('-inf')
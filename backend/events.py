@@ -0,0 +1,119 @@
+# backend/events.py
+
+import json
+import time
+import queue
+import threading
+from log_config import get_logger
+
+logger = get_logger('events')
+
+# Events buffered per subscriber; a client that falls further behind misses
+# events and resynchronizes from the snapshot sent when it reconnects
+SUBSCRIBER_QUEUE_SIZE = 256
+# Redis channel prefix, one channel per session
+CHANNEL_PREFIX = 'events:'
+
+class Subscription:
+    """Events of one session for one listener"""
+
+    def __init__(self, broadcaster, session_id):
+        self.broadcaster = broadcaster
+        self.session_id = session_id
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def get(self, timeout=None):
+        """Next event as a dict, or None if none arrived within timeout seconds"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broadcaster.unsubscribe(self)
+
+class MemoryBroadcaster:
+    """Delivers events to the subscribers in this process"""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, session_id):
+        subscription = Subscription(self, session_id)
+        with self._lock:
+            self._subscribers.setdefault(session_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.session_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.session_id]
+
+    def publish(self, session_id, event):
+        self.deliver(session_id, event)
+
+    def deliver(self, session_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(session_id, ()))
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(event)
+            except queue.Full:
+                pass
+
+class RedisBroadcaster(MemoryBroadcaster):
+    """Publishes events on Redis so the subscribers of every worker receive them
+
+    Each process holds a single pub/sub connection, listening on all session
+    channels from a background thread, and hands the events to its local
+    subscribers. The listener is started with the first subscription and
+    reconnects with backoff if the connection drops.
+    """
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+        self._listener = None
+
+    def subscribe(self, session_id):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, daemon=True)
+                self._listener.start()
+        return super().subscribe(session_id)
+
+    def publish(self, session_id, event):
+        self.client.publish(CHANNEL_PREFIX + session_id, json.dumps(event))
+
+    def _listen(self):
+        delay = 0.1
+        while True:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.psubscribe(CHANNEL_PREFIX + '*')
+                delay = 0.1
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        session_id = message['channel'][len(CHANNEL_PREFIX):]
+                        self.deliver(session_id, json.loads(message['data']))
+            except Exception as e:
+                logger.warning("event listener disconnected (%s), retrying in %.1fs", e, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, 5.0)
+            finally:
+                pubsub.close()
+
+def create_broadcaster(redis_client):
+    """Event broadcaster over Redis pub/sub, or in-process if there is no Redis"""
+    if redis_client is not None:
+        return RedisBroadcaster(redis_client)
+    return MemoryBroadcaster()
+
+def format_event(event):
+    """Server-sent event frame for an event dict with a 'type'"""
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
@@ -0,0 +1,203 @@
+# backend/feature_store.py
+
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from similarity import build_feature_matrix, similarity_block, similarity_bytes
+
+# Capacity grows by this factor, so appends cost amortized O(N)
+GROWTH_FACTOR = 1.25
+MIN_CAPACITY = 16
+# Sessions not generated or submitted to for this many seconds are dropped
+IDLE_SECONDS = 3600
+
+class FeatureSnapshot:
+    """Features, similarity matrix and positions of a session at one survey count
+
+    Taken under the store's lock. Later submissions only write rows and
+    columns past count and the positions are a copy, so the snapshot stays
+    consistent with the survey list it was taken for.
+    """
+
+    def __init__(self, features, similarity, positions):
+        self.features = features
+        self.similarity = similarity
+        self.positions = positions
+
+class SessionFeatures:
+    """Feature rows and similarity matrix of one session, grown one user at a time
+
+    The dense similarity matrix is only kept while it fits in memory_limit
+    (bytes); beyond that only the features are cached.
+    """
+
+    def __init__(self, characteristics, memory_limit=None):
+        self.characteristics = tuple(characteristics)
+        self.memory_limit = memory_limit
+        self.ids = []
+        # Survey id -> position in the session's survey list
+        self.positions = {}
+        self.count = 0
+        self._features = np.empty((0, len(self.characteristics)), dtype=np.float32)
+        self._similarity = np.empty((0, 0), dtype=np.float32)
+
+    @property
+    def features(self):
+        """(N, k) feature matrix"""
+        return self._features[:self.count]
+
+    @property
+    def similarity(self):
+        """(N, N) similarity matrix with a zero diagonal, or None over the memory limit"""
+        if self._similarity is None:
+            return None
+        return self._similarity[:self.count, :self.count]
+
+    @property
+    def nbytes(self):
+        """Memory held by the allocated feature and similarity buffers"""
+        return self._features.nbytes + (self._similarity.nbytes if self._similarity is not None else 0)
+
+    def snapshot(self):
+        """FeatureSnapshot at the current count"""
+        return FeatureSnapshot(self.features, self.similarity, dict(self.positions))
+
+    def _reserve(self, needed):
+        capacity = self._features.shape[0]
+        if needed <= capacity:
+            return
+        capacity = max(MIN_CAPACITY, needed, int(capacity * GROWTH_FACTOR))
+        features = np.empty((capacity, len(self.characteristics)), dtype=np.float32)
+        features[:self.count] = self.features
+        self._features = features
+        if self._similarity is None:
+            return
+        if self.memory_limit is not None and similarity_bytes(capacity, 'dense') > self.memory_limit:
+            # Too large to keep; make_teams picks a memory-bounded representation instead
+            self._similarity = None
+            return
+        similarity = np.zeros((capacity, capacity), dtype=np.float32)
+        similarity[:self.count, :self.count] = self.similarity
+        self._similarity = similarity
+
+    def extend(self, surveys):
+        """Append users, filling in one new row and column per user"""
+        if not surveys:
+            return
+        start = self.count
+        stop = start + len(surveys)
+        self._reserve(stop)
+        self._features[start:stop] = build_feature_matrix(surveys, self.characteristics)
+        for position, survey in enumerate(surveys, start):
+            self.ids.append(survey.get('id'))
+            self.positions.setdefault(survey.get('id'), position)
+        self.count = stop
+        if self._similarity is None:
+            return
+        # Similarities of the new rows against every user, mirrored into the columns
+        rows = similarity_block(self.features, start, stop)
+        self._similarity[start:stop, :stop] = rows
+        self._similarity[:stop, start:stop] = rows.T
+        self._similarity[np.arange(start, stop), np.arange(start, stop)] = 0
+
+    def matches(self, surveys):
+        """Whether the cached rows are a prefix of the given survey list"""
+        if len(surveys) < self.count:
+            return False
+        return self.count == 0 or surveys[self.count - 1].get('id') == self.ids[-1]
+
+class FeatureStore:
+    """Per-process cache of SessionFeatures, keyed by session id
+
+    Bounded by max_bytes over all sessions: the least recently used are
+    dropped beyond it, and sessions idle for idle_seconds are dropped too.
+    """
+
+    def __init__(self, max_bytes=None, idle_seconds=IDLE_SECONDS):
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self._sessions = OrderedDict()
+        self._last_used = {}
+        self._lock = threading.Lock()
+
+    def append(self, session_id, survey, index):
+        """Add a newly submitted survey (at position index) to the session's cached features
+
+        If the cache is missing rows, e.g. because another worker took the
+        earlier submissions, it is kept as it is and the next sync catches up.
+        """
+        self.extend(session_id, [survey], index)
+
+    def extend(self, session_id, surveys, index):
+        """Add a batch of surveys, the first one at position index
+
+        Surveys a sync already cached are skipped. Cached rows with other ids
+        at these positions mean the survey list changed, and the session's
+        cache is dropped.
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return
+            if entry.count < index:
+                # Gap left by other workers' submissions; sync reads them from the survey list
+                self._touch(session_id)
+                return
+            cached = entry.ids[index:index + len(surveys)]
+            if cached != [survey.get('id') for survey in surveys[:len(cached)]]:
+                self._drop(session_id)
+                return
+            entry.extend(surveys[len(cached):])
+            self._touch(session_id)
+
+    def sync(self, session_id, characteristics, surveys, memory_limit=None):
+        """Snapshot of the session's features for the given characteristics, brought up to date
+
+        Only surveys that are not cached yet are processed. The cache is
+        rebuilt when the characteristics or memory limit change, or the
+        survey list no longer matches what was cached.
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if (entry is None or entry.characteristics != tuple(characteristics)
+                    or entry.memory_limit != memory_limit or not entry.matches(surveys)):
+                entry = SessionFeatures(characteristics, memory_limit)
+                self._sessions[session_id] = entry
+            entry.extend(surveys[entry.count:])
+            snapshot = entry.snapshot()
+            self._touch(session_id)
+            return snapshot
+
+    def cached_features(self, session_id, characteristics, surveys):
+        """The session's cached features if they cover exactly these surveys, else None"""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if (entry is None or entry.characteristics != tuple(characteristics)
+                    or entry.count != len(surveys) or not entry.matches(surveys)):
+                return None
+            return entry.features
+
+    def discard(self, session_id):
+        """Drop the cached features of a session"""
+        with self._lock:
+            self._drop(session_id)
+
+    def _drop(self, session_id):
+        self._sessions.pop(session_id, None)
+        self._last_used.pop(session_id, None)
+
+    def _touch(self, session_id):
+        """Mark a session as just used and evict idle and least recently used sessions (lock held)"""
+        now = time.monotonic()
+        self._sessions.move_to_end(session_id)
+        self._last_used[session_id] = now
+        for other in [s for s, used in self._last_used.items() if now - used > self.idle_seconds]:
+            self._drop(other)
+        if self.max_bytes is None:
+            return
+        total = sum(entry.nbytes for entry in self._sessions.values())
+        while total > self.max_bytes and len(self._sessions) > 1:
+            oldest = next(iter(self._sessions))
+            total -= self._sessions[oldest].nbytes
+            self._drop(oldest)
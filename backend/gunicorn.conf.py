@@ -0,0 +1,46 @@
+# backend/gunicorn.conf.py
+"""Production server settings
+
+Run from the repository root with:
+    gunicorn --config backend/gunicorn.conf.py
+
+The app is loaded once in the master (preload) and forked into the workers,
+so they start without importing it again. NumPy and the team logic are
+imported by each worker on its first team generation.
+"""
+
+import os
+import glob
+import tempfile
+import multiprocessing
+
+# Flat imports in the backend (from team_logic import ...) need it as the working directory
+chdir = os.path.dirname(os.path.abspath(__file__))
+wsgi_app = 'app:app'
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+preload_app = True
+
+# Sessions in the in-memory fallback are private to one process, so more
+# than one worker needs Redis
+_has_redis = bool(os.environ.get('REDISCLOUD_URL') or os.environ.get('REDIS_URL'))
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() if _has_redis else 1))
+# Read by jobs.py, which splits the CPUs between the web workers' job pools
+os.environ['WEB_CONCURRENCY'] = str(workers)
+# Every open event stream (/events) holds a thread of a gthread worker, so
+# app.py keeps EVENT_RESERVED_THREADS of them for the other requests. gevent
+# workers are not an option: the job pool's pipes would block their event loop.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 64))
+os.environ['GUNICORN_THREADS'] = str(threads)
+# Workers write their metrics here and /metrics serves the sum (metrics.py)
+if not os.environ.get('METRICS_DIR'):
+    os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='team_sync_metrics_')
+# Team generation runs for seconds on large sessions
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+accesslog = None
+
+def on_starting(server):
+    # Counts left over from an earlier run in a fixed METRICS_DIR
+    os.makedirs(os.environ['METRICS_DIR'], exist_ok=True)
+    for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], '*.json')):
+        os.remove(path)
@@ -0,0 +1,262 @@
+# backend/jobs.py
+
+import os
+import time
+import uuid
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from log_config import get_logger, log_event
+
+logger = get_logger('jobs')
+
+# Number of processes running team-generation jobs, per web worker; each web
+# worker has its own pool, so by default they share the CPUs between them
+WEB_WORKERS = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+JOB_WORKERS = int(os.environ.get('TEAM_JOB_WORKERS', max(1, (os.cpu_count() or 1) // WEB_WORKERS)))
+# Report progress only in steps of at least this fraction
+PROGRESS_STEP = 0.05
+
+# Spawned (not forked) workers, since the web process runs threads
+_context = multiprocessing.get_context('spawn')
+_executor = None
+_progress_queue = None
+_lock = threading.Lock()
+
+# Queue for progress messages, set in each worker process
+_worker_queue = None
+
+def _init_worker(queue):
+    global _worker_queue
+    _worker_queue = queue
+
+def _run_make_teams(job_id, users, options, features):
+    """Job body, run in a worker process"""
+    from team_logic import make_teams
+
+    _worker_queue.put((job_id, {'status': 'running', 'progress': 0.0}))
+    reported = [0.0]
+
+    def progress(done):
+        if done - reported[0] >= PROGRESS_STEP:
+            reported[0] = done
+            _worker_queue.put((job_id, {'progress': round(done, 3)}))
+
+    return make_teams(users=users, features=features, progress=progress, return_details=True, **options)
+
+def _run_shared_make_teams(block_name, features_at, similarity_at, users, options):
+    """Batch task body, run in a worker process on matrices read from shared memory
+
+    features_at and similarity_at are (offset, shape) in the block;
+    similarity_at is None when the worker builds its own matrix.
+    """
+    import numpy as np
+    from multiprocessing import shared_memory
+    from team_logic import make_teams
+
+    block = shared_memory.SharedMemory(name=block_name)
+    try:
+        features = np.ndarray(features_at[1], dtype=np.float32, buffer=block.buf, offset=features_at[0])
+        similarity = None
+        if similarity_at is not None:
+            similarity = np.ndarray(similarity_at[1], dtype=np.float32, buffer=block.buf, offset=similarity_at[0])
+        result = make_teams(users=users, features=features, similarity_matrix=similarity,
+                            return_details=True, **options)
+        # The views must be gone before the block can be closed
+        del features, similarity
+        return result
+    finally:
+        block.close()
+
+def _forward_progress(queue, storage):
+    """Copy progress messages from the workers into the job records"""
+    while True:
+        job_id, fields = queue.get()
+        try:
+            job = storage.get_job(job_id)
+            # The result may already be in when a late progress message arrives
+            if job and job.get('status') not in ('done', 'failed'):
+                storage.update_job(job_id, dict(fields, updated_at=time.time()))
+        except Exception:
+            logger.exception("error updating job %s", job_id)
+
+def _get_executor(storage):
+    global _executor, _progress_queue
+    with _lock:
+        if _progress_queue is None:
+            _progress_queue = _context.Queue()
+            threading.Thread(target=_forward_progress, args=(_progress_queue, storage), daemon=True).start()
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=JOB_WORKERS,
+                mp_context=_context,
+                initializer=_init_worker,
+                initargs=(_progress_queue,)
+            )
+        return _executor
+
+def _submit(storage, fn, *args):
+    """Submit to the pool, replacing it first if a worker died (e.g. killed for memory)
+
+    Tasks that were running in the broken pool fail with BrokenProcessPool;
+    later ones start on a fresh pool.
+    """
+    global _executor
+    executor = _get_executor(storage)
+    try:
+        return executor.submit(fn, *args)
+    except BrokenProcessPool:
+        logger.warning("job pool broken, starting a new one")
+        with _lock:
+            if _executor is executor:
+                _executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+        return _get_executor(storage).submit(fn, *args)
+
+def _worker_users(users, options):
+    """Only the survey fields a worker needs: ids and the characteristics constraints refer to"""
+    fields = ['id'] + [entry.get('characteristic') for entry in
+                       ((options.get('constraints') or {}).get('min_per_team') or [])]
+    return [{field: user[field] for field in fields if field in user} for user in users]
+
+def restart_options(options, restarts):
+    """make_teams options of each run of a generation with restarts
+
+    The runs get consecutive seeds. Up to JOB_WORKERS of them run at once,
+    so each may use only that share of the similarity memory limit.
+    """
+    if restarts <= 1 or not options.get('optimizer'):
+        return [options]
+    from team_logic import restart_seeds
+    memory_limit_mb = options.get('memory_limit_mb')
+    if memory_limit_mb:
+        memory_limit_mb /= min(restarts, JOB_WORKERS)
+    return [dict(options, seed=seed, memory_limit_mb=memory_limit_mb)
+            for seed in restart_seeds(options.get('seed'), restarts)]
+
+def submit_team_job(storage, session_id, users, options, features=None, on_done=None, restarts=1):
+    """Run make_teams for a session in the process pool and return the job id
+
+    options are keyword arguments for make_teams. on_done, if given, is
+    called in this process with the make_teams result and returns what is
+    stored as the job result. With restarts, the runs of restart_options()
+    are queued at once and the job's result is the best of them.
+    """
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    storage.create_job(job_id, {
+        'id': job_id,
+        'session_id': session_id,
+        'status': 'queued',
+        'progress': 0.0,
+        'created_at': now,
+        'updated_at': now
+    })
+    # With the features at hand the worker needs little more than the ids
+    if features is not None:
+        users = _worker_users(users, options)
+    futures = [_submit(storage, _run_make_teams, job_id, users, run, features)
+               for run in restart_options(options, restarts)]
+    log_event(logger, logging.INFO, "team job queued", job_id=job_id, session_id=session_id, users=len(users),
+              restarts=len(futures))
+    pending = [len(futures)]
+    lock = threading.Lock()
+
+    def finish(_):
+        # The job completes with its last run
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        try:
+            results = [future.result() for future in futures if future.exception() is None]
+            if not results:
+                futures[0].result()
+            if len(futures) > 1:
+                from team_logic import best_result
+                result = best_result(results, options['team_approach'])
+            else:
+                result = results[0]
+            if on_done:
+                result = on_done(result)
+            storage.update_job(job_id, {'status': 'done', 'progress': 1.0, 'result': result,
+                                        'updated_at': time.time()})
+        except Exception as e:
+            logger.exception("team job %s failed", job_id)
+            storage.update_job(job_id, {'status': 'failed', 'error': str(e), 'updated_at': time.time()})
+
+    for future in futures:
+        future.add_done_callback(finish)
+    return job_id
+
+def completed_team_job(storage, session_id, result):
+    """Record a job that is already done with the given result and return its id
+
+    Lets an asynchronous request that was answered from the result cache be
+    followed like any other job.
+    """
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    storage.create_job(job_id, {
+        'id': job_id,
+        'session_id': session_id,
+        'status': 'done',
+        'progress': 1.0,
+        'result': result,
+        'created_at': now,
+        'updated_at': now
+    })
+    return job_id
+
+def run_team_batch(storage, tasks):
+    """Run make_teams for several sessions at once across the process pool
+
+    tasks is a list of (users, features, options) with features an (N, k)
+    float32 matrix per session, or (users, features, options, similarity)
+    with a dense (N, N) similarity matrix the workers use instead of
+    building their own. All matrices are copied into one shared memory
+    block that the workers read in place, so they are not pickled per task;
+    tasks on the same matrix (e.g. restarts) share one copy.
+    Returns one (result, error) pair per task, in order.
+    """
+    import numpy as np
+    from multiprocessing import shared_memory
+
+    # Offset of every distinct matrix in the block
+    matrices = {}
+    size = 0
+    for task in tasks:
+        for matrix in task[1:2] + task[3:4]:
+            if matrix is not None and id(matrix) not in matrices:
+                contiguous = np.ascontiguousarray(matrix, dtype=np.float32)
+                matrices[id(matrix)] = (contiguous, size)
+                size += contiguous.nbytes
+    block = shared_memory.SharedMemory(create=True, size=max(1, size))
+    try:
+        for matrix, offset in matrices.values():
+            np.ndarray(matrix.shape, dtype=np.float32, buffer=block.buf, offset=offset)[:] = matrix
+
+        def location(matrix):
+            if matrix is None:
+                return None
+            contiguous, offset = matrices[id(matrix)]
+            return offset, contiguous.shape
+
+        futures = []
+        for task in tasks:
+            users, features, options = task[:3]
+            similarity = task[3] if len(task) > 3 else None
+            futures.append(_submit(storage, _run_shared_make_teams, block.name, location(features),
+                                   location(similarity), _worker_users(users, options), options))
+        results = []
+        for future in futures:
+            try:
+                results.append((future.result(), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
+    finally:
+        block.close()
+        block.unlink()
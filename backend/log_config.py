@@ -0,0 +1,58 @@
+# backend/log_config.py
+
+import os
+import random
+import logging
+
+# LOG_LEVEL picks the lowest level written (default INFO). LOG_SAMPLE_RATE is
+# the fraction of DEBUG records kept (default 1.0), so debug logging can stay
+# on in production without flooding the log drain.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 1.0))
+
+class SamplingFilter(logging.Filter):
+    """Keep only a random fraction of records below INFO"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.INFO or random.random() < self.rate
+
+class KeyValueFormatter(logging.Formatter):
+    """Append the record's structured fields as key=value pairs"""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f"{key}={_format_value(value)}" for key, value in fields.items())
+        return line
+
+def _format_value(value):
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    text = str(value)
+    return f'"{text}"' if ' ' in text else text
+
+_configured = False
+
+def get_logger(name):
+    """Logger writing level-gated, sampled key=value lines to stderr"""
+    global _configured
+    if not _configured:
+        handler = logging.StreamHandler()
+        handler.setFormatter(KeyValueFormatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+        handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+        root = logging.getLogger('team_sync')
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+        root.propagate = False
+        _configured = True
+    return logging.getLogger(f'team_sync.{name}')
+
+def log_event(logger, level, event, **fields):
+    """Log a short event name with summary fields (sizes, timings, objective values)"""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'fields': fields})
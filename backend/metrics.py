@@ -0,0 +1,226 @@
+# backend/metrics.py
+
+import os
+import glob
+import json
+import time
+import atexit
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Latency buckets in seconds
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Payload size buckets in bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+# Session size buckets (number of surveys)
+COUNT_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000, 50000)
+# Directory shared by the worker processes (gunicorn.conf.py sets one). Each
+# worker writes its histograms there and /metrics serves the sum of them all.
+METRICS_DIR = os.environ.get('METRICS_DIR')
+# How often a worker writes its histograms to METRICS_DIR
+FLUSH_SECONDS = 1.0
+
+class Histogram:
+    """Prometheus-style cumulative histogram with labels"""
+
+    def __init__(self, name, help_text, buckets, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(label_names)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (last slot is +Inf), sum, count
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][slot] += 1
+            series[1] += value
+            series[2] += 1
+
+    def dump(self):
+        """Copy of the series as [key, counts, sum, count] lists"""
+        with self._lock:
+            return [[list(key), list(counts), total, count] for key, (counts, total, count) in self._series.items()]
+
+    def render(self, series=None):
+        """Text format of these series, or of the given dumped ones"""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        if series is None:
+            series = self.dump()
+        for key, counts, total, count in sorted(series):
+            labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, key)]
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                bucket_labels = ','.join(labels + [f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            plain = '{' + ','.join(labels) + '}' if labels else ''
+            lines.append(f"{self.name}_sum{plain} {total}")
+            lines.append(f"{self.name}_count{plain} {count}")
+        return '\n'.join(lines)
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Registry:
+    """Holds the histograms of this process
+
+    With a directory, every process that called share() writes its series
+    there and render() adds up the files of all of them, including workers
+    that have since exited, so the counts never go down.
+    """
+
+    def __init__(self, directory=None):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.directory = directory
+        self._shared_pid = None
+        self._path = None
+
+    def histogram(self, name, help_text, buckets=TIME_BUCKETS, label_names=()):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Histogram(name, help_text, buckets, label_names)
+            return self._metrics[name]
+
+    def share(self):
+        """Start writing this process's series to the directory
+
+        Called on every request; only the first call after a fork starts
+        the flush thread, threads do not survive the fork.
+        """
+        pid = os.getpid()
+        if self.directory is None or self._shared_pid == pid:
+            return
+        with self._lock:
+            if self._shared_pid == pid:
+                return
+            self._shared_pid = pid
+            # The start time keeps a reused pid from overwriting an exited worker's file
+            self._path = os.path.join(self.directory, f"{pid}-{time.time_ns()}.json")
+        threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+        atexit.register(self.flush)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_SECONDS)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def flush(self):
+        if self._path is None:
+            return
+        data = {name: metric.dump() for name, metric in self._metrics.items()}
+        temp = f"{self._path}.tmp"
+        with open(temp, 'w') as f:
+            json.dump(data, f)
+        # Readers never see a half-written file
+        os.replace(temp, self._path)
+
+    def _merged(self):
+        self.flush()
+        merged = {name: {} for name in self._metrics}
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, series in data.items():
+                target = merged.get(name)
+                if target is None:
+                    continue
+                for key, counts, total, count in series:
+                    entry = target.get(tuple(key))
+                    if entry is None:
+                        target[tuple(key)] = [key, counts, total, count]
+                    else:
+                        entry[1] = [a + b for a, b in zip(entry[1], counts)]
+                        entry[2] += total
+                        entry[3] += count
+        return {name: list(series.values()) for name, series in merged.items()}
+
+    def render(self):
+        if self.directory is None:
+            return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+        merged = self._merged()
+        return '\n'.join(metric.render(merged[name]) for name, metric in self._metrics.items()) + '\n'
+
+REGISTRY = Registry(METRICS_DIR)
+
+request_seconds = REGISTRY.histogram(
+    'team_sync_request_seconds', 'HTTP request latency in seconds.',
+    TIME_BUCKETS, ('route', 'method', 'status'))
+stage_seconds = REGISTRY.histogram(
+    'team_sync_stage_seconds', 'Duration of request stages in seconds.',
+    TIME_BUCKETS, ('route', 'stage'))
+payload_bytes = REGISTRY.histogram(
+    'team_sync_payload_bytes', 'Request and response body sizes in bytes.',
+    SIZE_BUCKETS, ('route', 'direction'))
+session_surveys = REGISTRY.histogram(
+    'team_sync_session_surveys', 'Number of surveys (N) in the sessions handled.',
+    COUNT_BUCKETS, ('route',))
+
+# Route template of the request being handled, used as the metric label
+current_route = contextvars.ContextVar('current_route', default='none')
+
+@contextmanager
+def stage(name):
+    """Time a block of code as one stage of the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, route=current_route.get(), stage=name)
+
+def observe_stage(name, seconds):
+    """Record a stage duration measured elsewhere"""
+    stage_seconds.observe(seconds, route=current_route.get(), stage=name)
+
+def observe_surveys(count):
+    session_surveys.observe(count, route=current_route.get())
+
+def init_app(app):
+    """Record latency and payload sizes of every request and serve them at /metrics"""
+    from flask import Response, g, request
+
+    @app.before_request
+    def _start_timer():
+        REGISTRY.share()
+        g.metrics_start = time.perf_counter()
+        rule = request.url_rule
+        g.metrics_token = current_route.set(rule.rule if rule is not None else 'unmatched')
+
+    @app.after_request
+    def _record_request(response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        route = current_route.get()
+        request_seconds.observe(time.perf_counter() - start, route=route,
+                                method=request.method, status=response.status_code)
+        if request.content_length:
+            payload_bytes.observe(request.content_length, route=route, direction='in')
+        if not response.is_streamed and response.content_length is not None:
+            payload_bytes.observe(response.content_length, route=route, direction='out')
+        return response
+
+    @app.teardown_request
+    def _reset_route(exc):
+        token = g.pop('metrics_token', None)
+        if token is not None:
+            current_route.reset(token)
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
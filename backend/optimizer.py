@@ -0,0 +1,373 @@
+# backend/optimizer.py
+
+import math
+import time
+import numpy as np
+from similarity import as_similarity
+
+# Default wall-clock budget (seconds) for one optimization run
+DEFAULT_TIME_BUDGET = 1.0
+# Default number of swap attempts per user when no iteration budget is given
+ITERATIONS_PER_USER = 100
+# Check the clock only every this many iterations
+CLOCK_INTERVAL = 256
+# Moves timed to turn a time budget into an iteration budget
+CALIBRATION_MOVES = 1024
+# Share of the remaining budget the iteration budget is sized for; the rest
+# absorbs timing noise, so the time limit rarely has to cut the search short
+CALIBRATION_MARGIN = 0.8
+
+def labels_from_teams(teams, num_users):
+    """Convert a list of index lists into a label array (team number per user)"""
+    labels = np.full(num_users, -1, dtype=np.int64)
+    for team_no, team in enumerate(teams):
+        labels[list(team)] = team_no
+    return labels
+
+def teams_from_labels(labels, num_teams=None):
+    """Convert a label array back into a list of index lists"""
+    labels = np.asarray(labels)
+    if num_teams is None:
+        num_teams = int(labels.max()) + 1 if labels.size else 0
+    order = np.argsort(labels, kind='stable')
+    bounds = np.searchsorted(labels[order], np.arange(num_teams + 1))
+    return [order[bounds[t]:bounds[t + 1]].tolist() for t in range(num_teams)]
+
+class SwapState:
+    """Team assignment with the per-team pair similarity sums kept up to date
+
+    similarity is a dense matrix or any representation from similarity.py.
+    """
+
+    def __init__(self, similarity, labels):
+        similarity = as_similarity(similarity)
+        self.similarity = similarity
+        self.labels = np.array(labels, dtype=np.int64)
+        self.num_teams = int(self.labels.max()) + 1 if self.labels.size else 0
+        self.members = [np.array(team, dtype=np.int64) for team in teams_from_labels(self.labels, self.num_teams)]
+        # Position of each user inside its team's member array
+        self.position = np.empty(len(self.labels), dtype=np.int64)
+        for team in self.members:
+            self.position[team] = np.arange(len(team))
+        sizes = np.array([len(team) for team in self.members], dtype=np.float64)
+        self.pairs = sizes * (sizes - 1) / 2
+        self.pair_sums = np.array([
+            float(similarity.block(team).sum()) / 2 for team in self.members
+        ])
+
+    def team_thi(self):
+        """THI per team: 1 - average pair similarity, 0 for teams under two members"""
+        thi = np.zeros(self.num_teams)
+        mask = self.pairs > 0
+        thi[mask] = 1 - self.pair_sums[mask] / self.pairs[mask]
+        return thi
+
+    def objective(self):
+        """Mean team THI"""
+        if not self.num_teams:
+            return 0.0
+        return float(self.team_thi().mean())
+
+    def swap_delta(self, a, b):
+        """Change of the pair sums of both teams if users a and b swap teams"""
+        team_a, team_b = self.labels[a], self.labels[b]
+        similarity = self.similarity
+        members_a, members_b = self.members[team_a], self.members[team_b]
+        between = similarity.pair(a, b)
+        # The diagonal is zero, so a's own entry does not count towards its team
+        delta_a = similarity.take(b, members_a).sum() - between - similarity.take(a, members_a).sum()
+        delta_b = similarity.take(a, members_b).sum() - between - similarity.take(b, members_b).sum()
+        return float(delta_a), float(delta_b)
+
+    def objective_delta(self, a, b, delta_a, delta_b):
+        """Change of the mean team THI for the given pair sum changes"""
+        team_a, team_b = self.labels[a], self.labels[b]
+        change = 0.0
+        if self.pairs[team_a]:
+            change -= delta_a / self.pairs[team_a]
+        if self.pairs[team_b]:
+            change -= delta_b / self.pairs[team_b]
+        return change / self.num_teams
+
+    def apply_swap(self, a, b, delta_a, delta_b):
+        """Swap users a and b between their teams"""
+        team_a, team_b = self.labels[a], self.labels[b]
+        pos_a, pos_b = self.position[a], self.position[b]
+        self.members[team_a][pos_a] = b
+        self.members[team_b][pos_b] = a
+        self.position[a], self.position[b] = pos_b, pos_a
+        self.labels[a], self.labels[b] = team_b, team_a
+        self.pair_sums[team_a] += delta_a
+        self.pair_sums[team_b] += delta_b
+
+    def restore(self, labels):
+        """Go back to an earlier assignment with the same team sizes
+
+        Only the teams whose members differ get their pair sums recomputed.
+        """
+        labels = np.asarray(labels, dtype=np.int64)
+        changed = np.flatnonzero(self.labels != labels)
+        if not changed.size:
+            return
+        affected = np.unique(np.concatenate([self.labels[changed], labels[changed]])).tolist()
+        self.labels = labels.copy()
+        teams = teams_from_labels(self.labels, self.num_teams)
+        for team in affected:
+            members = np.array(teams[team], dtype=np.int64)
+            self.members[team] = members
+            self.position[members] = np.arange(len(members))
+            self.pair_sums[team] = float(self.similarity.block(members).sum()) / 2
+
+def calibrate_iterations(similarity, labels, time_budget, constraints=None, state=None):
+    """Number of swap attempts that take about time_budget seconds on this data
+
+    A sample of complete moves is timed up front, so that a search can be
+    bounded by an iteration count, which unlike the clock makes a seeded
+    search reproducible. Every move is counted as accepted: it is applied
+    and swapped back, along with the constraints' bookkeeping if any. The
+    calibration's own time counts against time_budget. Capped at
+    ITERATIONS_PER_USER per user. state, if given, is the SwapState of
+    labels and is left as it was.
+    """
+    start = time.perf_counter()
+    if state is None:
+        state = SwapState(similarity, labels)
+    n = len(state.labels)
+    if state.num_teams < 2:
+        return 0
+    pair_sums = state.pair_sums.copy()
+    # A fixed sample, so the calibration does not consume the search's random numbers
+    rng = np.random.default_rng(0)
+    moves = []
+    evaluated = time.perf_counter()
+    firsts = rng.integers(0, n, size=CALIBRATION_MOVES).tolist()
+    seconds = rng.integers(0, n, size=CALIBRATION_MOVES).tolist()
+    draws = rng.random(CALIBRATION_MOVES).tolist()
+    accepts = 0
+    for a, b, draw in zip(firsts, seconds, draws):
+        if state.labels[a] == state.labels[b]:
+            continue
+        hard = soft = 0
+        if constraints is not None:
+            hard, soft = constraints.swap_delta(a, b)
+        delta_a, delta_b = state.swap_delta(a, b)
+        gain = -abs(state.objective_delta(a, b, delta_a, delta_b))
+        if constraints is not None:
+            gain -= constraints.penalty(hard, soft)
+        # The acceptance test of a worsening move
+        accepts += draw < math.exp(max(gain, -50.0))
+        moves.append((a, b, delta_a, delta_b, hard, soft))
+    evaluated = time.perf_counter() - evaluated
+    applied = time.perf_counter()
+    for a, b, delta_a, delta_b, hard, soft in moves:
+        if constraints is not None:
+            constraints.apply_swap(a, b, hard, soft)
+        state.apply_swap(a, b, delta_a, delta_b)
+        # Swapping the same two users again undoes the move
+        if constraints is not None:
+            constraints.apply_swap(a, b, -hard, -soft)
+        state.apply_swap(a, b, -delta_b, -delta_a)
+    applied = time.perf_counter() - applied
+    # Exact sums again, not ones that went through the undone moves
+    state.pair_sums = pair_sums
+    per_move = max((evaluated + applied / 2) / CALIBRATION_MOVES, 1e-9)
+    remaining = max(time_budget - (time.perf_counter() - start), 0.0) * CALIBRATION_MARGIN
+    return max(CLOCK_INTERVAL, min(int(remaining / per_move), ITERATIONS_PER_USER * n))
+
+def mean_team_thi(similarity, teams):
+    """Mean team THI of a team assignment given as lists of user indices"""
+    if not teams:
+        return 0.0
+    return SwapState(similarity, labels_from_teams(teams, similarity.shape[0])).objective()
+
+def _run_swaps(similarity, labels, maximize, temperature, time_budget, max_iterations, target, rng, progress=None,
+               constraints=None, time_limit=None, state=None):
+    """Shared swap loop for local search (temperature 0) and simulated annealing
+
+    time_limit (seconds) stops the search like time_budget, but only as a
+    safety stop: it does not count towards the progress of the schedule.
+    With constraints (a constraints.ConstraintSet on the same labels), swaps
+    that would break a hard constraint are skipped before their objective
+    change is computed, and soft violations count as penalties. The best
+    assignment reached is returned, not the one the search ends in. state,
+    if given, is a SwapState of labels to start from instead of a new one.
+    """
+    if state is None:
+        state = SwapState(similarity, labels)
+    n = len(state.labels)
+    sign = 1.0 if maximize else -1.0
+    objective = state.objective()
+    initial_objective = objective
+    if time_budget is None and max_iterations is None:
+        time_budget = DEFAULT_TIME_BUDGET
+    if max_iterations is None:
+        max_iterations = ITERATIONS_PER_USER * n
+
+    start = time.perf_counter()
+    deadline = start + time_budget if time_budget is not None else None
+    if time_limit is not None:
+        deadline = min(deadline, start + time_limit) if deadline is not None else start + time_limit
+    iterations = accepted = 0
+    timed_out = False
+    # Objective less penalties, maximized; the labels of the best state are
+    # copied only when a move leaves it, and are None while it is the current one
+    score = sign * objective
+    if constraints is not None:
+        score -= constraints.penalty(constraints.hard_violations, constraints.soft_violations)
+    best_score = score
+    best_labels = None
+
+    def reached(value):
+        if constraints is not None and constraints.hard_violations:
+            return False
+        return target is not None and sign * (value - target) >= 0
+
+    if state.num_teams > 1 and not reached(objective):
+        # Draw candidates in batches to keep the per-iteration overhead low
+        while iterations < max_iterations:
+            temp = temperature(iterations, time.perf_counter() - start) if temperature else 0.0
+            batch = min(CLOCK_INTERVAL, max_iterations - iterations)
+            firsts = rng.integers(0, n, size=batch).tolist()
+            seconds = rng.integers(0, n, size=batch).tolist()
+            draws = rng.random(batch).tolist()
+            for a, b, draw in zip(firsts, seconds, draws):
+                if state.labels[a] == state.labels[b]:
+                    continue
+                if constraints is not None:
+                    hard, soft = constraints.swap_delta(a, b)
+                    if hard > 0:
+                        continue
+                delta_a, delta_b = state.swap_delta(a, b)
+                change = state.objective_delta(a, b, delta_a, delta_b)
+                gain = sign * change
+                if constraints is not None:
+                    gain -= constraints.penalty(hard, soft)
+                if gain > 0 or (temp > 0 and draw < math.exp(max(gain / temp, -50.0))):
+                    if best_labels is None and gain < 0:
+                        best_labels = state.labels.copy()
+                    if constraints is not None:
+                        constraints.apply_swap(a, b, hard, soft)
+                    state.apply_swap(a, b, delta_a, delta_b)
+                    objective += change
+                    score += gain
+                    accepted += 1
+                    if score > best_score:
+                        best_score = score
+                        best_labels = None
+            iterations += batch
+            if reached(objective):
+                break
+            now = time.perf_counter()
+            if deadline is not None and now >= deadline:
+                timed_out = iterations < max_iterations
+                break
+            if progress is not None:
+                done = iterations / max_iterations
+                if time_budget:
+                    done = max(done, (now - start) / time_budget)
+                progress(min(done, 1.0))
+
+    if best_labels is not None:
+        # The search wandered off the best assignment it reached
+        state.restore(best_labels)
+        if constraints is not None:
+            constraints.reset(best_labels)
+    # Recompute from the sums to drop accumulated rounding
+    objective = state.objective()
+    return state.labels, {
+        'objective': objective,
+        'initial_objective': initial_objective,
+        'iterations': iterations,
+        'accepted': accepted,
+        'elapsed': time.perf_counter() - start,
+        'timed_out': timed_out,
+    }
+
+def local_search(similarity, labels, maximize, time_budget=None, max_iterations=None, target=None, rng=None,
+                 progress=None, constraints=None, time_limit=None, state=None):
+    """Hill climbing with random pair swaps, accepting only improvements"""
+    rng = rng if rng is not None else np.random.default_rng()
+    return _run_swaps(similarity, labels, maximize, None, time_budget, max_iterations, target, rng, progress,
+                      constraints, time_limit, state)
+
+def simulated_annealing(similarity, labels, maximize, time_budget=None, max_iterations=None, target=None,
+                        rng=None, progress=None, initial_temperature=None, constraints=None, time_limit=None,
+                        state=None):
+    """Simulated annealing with random pair swaps and a geometric cooling schedule"""
+    rng = rng if rng is not None else np.random.default_rng()
+    if state is None:
+        state = SwapState(similarity, labels)
+    n = len(state.labels)
+    if initial_temperature is None:
+        # Scale the temperature to the typical size of a swap move
+        samples = []
+        for _ in range(min(200, n * 2)):
+            a, b = rng.integers(0, n, size=2)
+            if state.labels[a] != state.labels[b]:
+                delta_a, delta_b = state.swap_delta(a, b)
+                samples.append(abs(state.objective_delta(a, b, delta_a, delta_b)))
+        initial_temperature = float(np.mean(samples)) if samples else 0.0
+    if not initial_temperature:
+        return local_search(similarity, labels, maximize, time_budget, max_iterations, target, rng, progress,
+                            constraints, time_limit, state)
+
+    total_iterations = max_iterations if max_iterations is not None else ITERATIONS_PER_USER * n
+    if time_budget is None and max_iterations is None:
+        time_budget = DEFAULT_TIME_BUDGET
+    final_temperature = initial_temperature * 1e-3
+
+    def temperature(iteration, elapsed):
+        # Progress is whichever budget is closer to running out
+        progress = iteration / total_iterations if total_iterations else 1.0
+        if time_budget:
+            progress = max(progress, elapsed / time_budget)
+        progress = min(progress, 1.0)
+        return initial_temperature * (final_temperature / initial_temperature) ** progress
+
+    return _run_swaps(similarity, labels, maximize, temperature, time_budget, max_iterations, target, rng,
+                      progress, constraints, time_limit, state)
+
+OPTIMIZERS = {
+    'local_search': local_search,
+    'annealing': simulated_annealing,
+}
+
+def optimize_teams(similarity, teams, maximize, optimizer='annealing', time_budget=DEFAULT_TIME_BUDGET,
+                   max_iterations=None, target=None, rng=None, progress=None, constraints=None):
+    """Improve a team assignment (lists of user indices) by maximizing or minimizing mean team THI
+
+    Team sizes are kept as they are. Returns the improved teams and a dict
+    with the achieved objective and search statistics. progress, if given,
+    is called now and then with the fraction of the budget used. constraints
+    is a constraints.ConstraintSet built on the same teams; it is updated
+    along with the swaps.
+
+    The search is bounded by max_iterations; without it, the time budget is
+    converted into an iteration budget before the search starts, reported
+    as max_iterations. The same rng seed and max_iterations then give the
+    same teams on any machine, unless the time budget, kept as a hard stop,
+    cut the search short (reported as timed_out). The pair sums are set up
+    once for calibration and search, and that setup counts against the
+    time budget too.
+    """
+    if optimizer not in OPTIMIZERS:
+        raise ValueError(f"Unknown optimizer: {optimizer}")
+    start = time.perf_counter()
+    labels = labels_from_teams(teams, similarity.shape[0])
+    state = SwapState(similarity, labels)
+    if max_iterations is None:
+        budget = time_budget if time_budget is not None else DEFAULT_TIME_BUDGET
+        max_iterations = calibrate_iterations(similarity, labels, budget - (time.perf_counter() - start),
+                                              constraints, state)
+    # The schedule follows the iterations only, so a seed reproduces it; the
+    # budget left after the setup is a safety stop
+    time_limit = None
+    if time_budget is not None:
+        time_limit = max(time_budget - (time.perf_counter() - start), 0.0)
+    labels, stats = OPTIMIZERS[optimizer](similarity, labels, maximize, time_budget=None,
+                                          max_iterations=max_iterations, target=target, rng=rng,
+                                          progress=progress, constraints=constraints, time_limit=time_limit,
+                                          state=state)
+    stats['optimizer'] = optimizer
+    stats['max_iterations'] = max_iterations
+    return teams_from_labels(labels, len(teams)), stats
@@ -0,0 +1,29 @@
+# backend/regenerate.py
+"""Regenerate the teams of several sessions at once, across all cores
+
+Usage:
+    python regenerate.py 123456 234567 --settings '{"team_size": 5}'
+
+Runs regenerate_sessions from the app against the configured storage
+(REDIS_URL) and prints the summary per session as JSON. --settings apply to
+every session for this run only; saved settings are left as they are.
+"""
+
+import json
+import argparse
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('session_ids', nargs='+', help='ids of the sessions to regenerate')
+    parser.add_argument('--settings', type=json.loads, default=None,
+                        help='JSON object of settings overriding those of every session')
+    args = parser.parse_args(argv)
+
+    # Imported here: loading the app connects to storage, which --help does not need
+    from app import regenerate_sessions
+    summary = regenerate_sessions(list(dict.fromkeys(args.session_ids)), args.settings)
+    print(json.dumps(summary, indent=2))
+    return 0 if all('error' not in entry for entry in summary.values()) else 1
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,63 @@
+# backend/result_cache.py
+
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Seconds a cached team-generation result is kept in Redis
+CACHE_TTL = 600
+# Entries kept in the in-process LRU tier
+LRU_SIZE = 128
+
+def result_key(session_id, surveys, options):
+    """Cache key from a content hash of the surveys and the team-generation options"""
+    digest = hashlib.sha256()
+    for survey in surveys:
+        digest.update(json.dumps(survey, sort_keys=True).encode())
+        digest.update(b'\n')
+    digest.update(json.dumps(options, sort_keys=True).encode())
+    return f"teams_cache:{session_id}:{digest.hexdigest()}"
+
+class ResultCache:
+    """Two-tier cache for team-generation results: in-process LRU in front of storage with a TTL
+
+    Keys contain a hash of the survey data and settings, so a new submission
+    or a settings change never hits an old entry; invalidate() additionally
+    frees the session's stale in-process entries.
+    """
+
+    def __init__(self, storage, size=LRU_SIZE, ttl=CACHE_TTL):
+        self.storage = storage
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = self.storage.get_cached(key)
+        if value is not None:
+            self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        self._remember(key, value)
+        self.storage.set_cached(key, value, self.ttl)
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, session_id):
+        """Drop the session's entries from the in-process tier"""
+        prefix = f"teams_cache:{session_id}:"
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                del self._entries[key]
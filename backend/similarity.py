@@ -0,0 +1,209 @@
+# backend/similarity.py
+
+import tempfile
+import numpy as np
+
+# Upper bound on the scratch memory used for one block of distances
+BLOCK_BYTES = 32 * 1024 * 1024
+
+def build_feature_matrix(users, characteristics, dtype=np.float32):
+    """Stack the selected characteristics of every user into an (N, k) matrix"""
+    if not users or not characteristics:
+        return np.zeros((len(users), len(characteristics)), dtype=dtype)
+    # Values may arrive as strings from the survey form, numpy parses them here
+    rows = [[user.get(char, 0) for char in characteristics] for user in users]
+    return np.asarray(np.array(rows, dtype=np.float64), dtype=dtype)
+
+def block_rows(n, block_bytes=BLOCK_BYTES):
+    """Number of matrix rows that fit in one float64 scratch block"""
+    return max(1, min(n, block_bytes // max(1, n * 8)))
+
+def similarity_block(features, start, stop, sq_norms=None):
+    """Similarities between rows start:stop and every row, as float64"""
+    data = np.asarray(features, dtype=np.float64)
+    if sq_norms is None:
+        sq_norms = np.einsum('ij,ij->i', data, data)
+    block = data[start:stop]
+    # Squared Euclidean distance via |a|^2 + |b|^2 - 2ab
+    dist = block @ data.T
+    dist *= -2
+    dist += sq_norms[start:stop, None]
+    dist += sq_norms[None, :]
+    np.maximum(dist, 0, out=dist)
+    np.sqrt(dist, out=dist)
+    # Same definition as calculate_similarity: 1 / (1 + distance)
+    dist += 1
+    np.reciprocal(dist, out=dist)
+    return dist
+
+def similarity_matrix(features, dtype=np.float32, block_bytes=BLOCK_BYTES):
+    """Compute the full N x N similarity matrix block by block
+
+    The diagonal is left at zero, matching the matrix make_teams used to
+    build pair by pair.
+    """
+    data = np.asarray(features, dtype=np.float64)
+    n = data.shape[0]
+    matrix = np.empty((n, n), dtype=dtype)
+    if n == 0:
+        return matrix
+    sq_norms = np.einsum('ij,ij->i', data, data)
+    step = block_rows(n, block_bytes)
+    for start in range(0, n, step):
+        stop = min(start + step, n)
+        matrix[start:stop] = similarity_block(data, start, stop, sq_norms)
+    np.fill_diagonal(matrix, 0)
+    return matrix
+
+# Similarity representations. The optimizer only ever needs the similarities
+# of one user to a handful of others (take/pair) and within one team (block),
+# so each representation implements those three lookups.
+
+class DenseSimilarity:
+    """Full N x N matrix in memory"""
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.shape = matrix.shape
+
+    def take(self, i, indices):
+        return self.matrix[i, indices]
+
+    def pair(self, i, j):
+        return float(self.matrix[i, j])
+
+    def block(self, indices):
+        return self.matrix[np.ix_(indices, indices)]
+
+class CondensedSimilarity:
+    """Upper triangle only, as float32, optionally backed by a memory-mapped file
+
+    Uses half the memory of the dense matrix. With a path the values are
+    spilled to disk through np.memmap and paged in as needed.
+    """
+
+    def __init__(self, features, path=None, block_bytes=BLOCK_BYTES):
+        data = np.asarray(features, dtype=np.float64)
+        n = data.shape[0]
+        self.n = n
+        self.shape = (n, n)
+        size = n * (n - 1) // 2
+        if path is not None:
+            self.values = np.memmap(path, dtype=np.float32, mode='w+', shape=(max(size, 1),))
+        else:
+            self.values = np.empty(size, dtype=np.float32)
+        if n < 2:
+            return
+        sq_norms = np.einsum('ij,ij->i', data, data)
+        step = block_rows(n, block_bytes)
+        # Tile by rows; each row keeps only the columns right of the diagonal
+        for start in range(0, n, step):
+            stop = min(start + step, n)
+            rows = similarity_block(data, start, stop, sq_norms)
+            for i in range(start, stop):
+                offset = self._offset(i)
+                self.values[offset:offset + n - i - 1] = rows[i - start, i + 1:]
+        if path is not None:
+            self.values.flush()
+
+    def _offset(self, i):
+        # Position of (i, i + 1) in the condensed array
+        return i * self.n - i * (i + 1) // 2
+
+    def _index(self, i, j):
+        low, high = np.minimum(i, j), np.maximum(i, j)
+        return low * self.n - low * (low + 1) // 2 + (high - low - 1)
+
+    def take(self, i, indices):
+        indices = np.asarray(indices)
+        result = np.zeros(indices.shape, dtype=np.float32)
+        mask = indices != i
+        result[mask] = self.values[self._index(i, indices[mask])]
+        return result
+
+    def pair(self, i, j):
+        return 0.0 if i == j else float(self.values[self._index(i, j)])
+
+    def block(self, indices):
+        indices = np.asarray(indices)
+        rows, cols = np.meshgrid(indices, indices, indexing='ij')
+        result = np.zeros(rows.shape, dtype=np.float32)
+        mask = rows != cols
+        result[mask] = self.values[self._index(rows[mask], cols[mask])]
+        return result
+
+class OnDemandSimilarity:
+    """Nothing precomputed: similarities are computed from the features per lookup
+
+    Needs only the (N, k) feature matrix, so memory stays linear in N.
+    """
+
+    def __init__(self, features):
+        self.features = np.asarray(features, dtype=np.float64)
+        n = self.features.shape[0]
+        self.shape = (n, n)
+
+    def take(self, i, indices):
+        diff = self.features[indices] - self.features[i]
+        result = 1 / (1 + np.sqrt(np.einsum('ij,ij->i', diff, diff)))
+        result[np.asarray(indices) == i] = 0
+        return result
+
+    def pair(self, i, j):
+        if i == j:
+            return 0.0
+        diff = self.features[i] - self.features[j]
+        return float(1 / (1 + np.sqrt(diff @ diff)))
+
+    def block(self, indices):
+        team = self.features[indices]
+        diff = team[:, None, :] - team[None, :, :]
+        result = 1 / (1 + np.sqrt(np.einsum('ijk,ijk->ij', diff, diff)))
+        np.fill_diagonal(result, 0)
+        return result
+
+SIMILARITY_MODES = ('auto', 'dense', 'condensed', 'memmap', 'on_demand')
+
+def similarity_bytes(n, mode):
+    """Memory a similarity representation of n users needs"""
+    if mode == 'dense':
+        return 4 * n * n
+    if mode == 'condensed':
+        return 4 * (n * (n - 1) // 2)
+    return 0
+
+def build_similarity(features, mode='auto', memory_limit=None, spill_path=None):
+    """Similarity representation for the given features
+
+    In 'auto' mode the dense matrix is used when it fits in memory_limit
+    (bytes, None for no limit), then the condensed triangle, and otherwise
+    similarities are computed on demand. 'memmap' stores the condensed
+    triangle in spill_path, or in a temporary file if none is given.
+    """
+    if mode not in SIMILARITY_MODES:
+        raise ValueError(f"Unknown similarity mode: {mode}")
+    n = len(features)
+    if mode == 'auto':
+        if memory_limit is None or similarity_bytes(n, 'dense') <= memory_limit:
+            mode = 'dense'
+        elif similarity_bytes(n, 'condensed') <= memory_limit:
+            mode = 'condensed'
+        else:
+            mode = 'on_demand'
+    if mode == 'dense':
+        return DenseSimilarity(similarity_matrix(features))
+    if mode == 'condensed':
+        return CondensedSimilarity(features)
+    if mode == 'memmap':
+        if spill_path is None:
+            # Unlinked right away on POSIX; the mapping keeps the data alive
+            with tempfile.NamedTemporaryFile(prefix='team_sync_similarity_', suffix='.f32') as spill:
+                return CondensedSimilarity(features, path=spill.name)
+        return CondensedSimilarity(features, path=spill_path)
+    return OnDemandSimilarity(features)
+
+def as_similarity(similarity):
+    """Wrap a plain matrix in DenseSimilarity; representations pass through"""
+    if isinstance(similarity, np.ndarray):
+        return DenseSimilarity(similarity)
+    return similarity
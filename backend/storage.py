@@ -0,0 +1,387 @@
+# backend/storage.py
+
+import os
+import json
+import threading
+from redis import ConnectionPool, Redis
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError, TimeoutError
+from redis.retry import Retry
+from metrics import stage
+
+# Seconds a team-generation job's state is kept
+JOB_TTL = 3600
+
+# Connections per process in the Redis pool, and seconds before a command times out
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', 5))
+# Attempts per command after a dropped connection, with exponential backoff up to 2 s
+REDIS_RETRIES = int(os.environ.get('REDIS_RETRIES', 5))
+
+# Redis key layout for one session:
+#   session:<id>:meta      hash with id and created_at
+#   session:<id>:settings  JSON string
+#   session:<id>:surveys   list, one JSON string per survey, in submission order
+#   session:<id>:seq       counter used to number surveys without an id
+#   session:<id>:teams     JSON string, display-ready teams (id and name per member)
+#   session:<id>:teams_anonymous JSON string, the same teams with anonymized names
+#   job:<id>               hash of JSON-encoded job fields, expires after JOB_TTL
+#   teams_cache:<id>:<hash> JSON team-generation result, see result_cache.py
+# Sessions written by older versions live in a single JSON blob under
+# session:<id> and are split into this layout the first time they are read.
+
+def session_key(sid, part=None):
+    """Redis key of a session, or of one part of it"""
+    return f"session:{sid}:{part}" if part else f"session:{sid}"
+
+def connect_redis(url):
+    """Redis client on a bounded connection pool that reconnects with backoff
+
+    Commands that hit a dropped or timed-out connection are retried on a new
+    one, so a Redis restart or failover shows up as slower requests rather
+    than errors, and never as a switch to per-process storage.
+    """
+    pool = ConnectionPool.from_url(
+        url,
+        decode_responses=True,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+        # Check idle connections before use, e.g. after the dyno slept
+        health_check_interval=30,
+        retry=Retry(ExponentialBackoff(cap=2, base=0.05), REDIS_RETRIES),
+        retry_on_error=[ConnectionError, TimeoutError]
+    )
+    return Redis(connection_pool=pool)
+
+class RedisStorage:
+    """Session storage on Redis with surveys as an append-only list"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def _migrate(self, sid):
+        """Split a legacy whole-session blob into the per-part layout"""
+        blob = self.client.get(session_key(sid))
+        if not blob:
+            return False
+        data = json.loads(blob)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(session_key(sid, 'meta'), mapping={
+            'id': data.get('id', sid),
+            'created_at': data.get('created_at', '')
+        })
+        pipe.set(session_key(sid, 'settings'), json.dumps(data.get('settings', {})))
+        pipe.delete(session_key(sid, 'surveys'))
+        if data.get('surveys'):
+            pipe.rpush(session_key(sid, 'surveys'), *[json.dumps(s) for s in data['surveys']])
+        pipe.set(session_key(sid, 'seq'), len(data.get('surveys', [])))
+        pipe.set(session_key(sid, 'teams'), json.dumps(data.get('teams', [])))
+        # The anonymized variant is derived on the first read
+        pipe.delete(session_key(sid, 'teams_anonymous'))
+        pipe.delete(session_key(sid))
+        pipe.execute()
+        return True
+
+    def session_exists(self, sid):
+        if self.client.exists(session_key(sid, 'meta')):
+            return True
+        return self._migrate(sid)
+
+    def _read(self, sid, queue):
+        """Run the reads queued by queue(pipe) in one round trip with the existence check
+
+        Returns their results, or None if the session does not exist.
+        """
+        pipe = self.client.pipeline(transaction=False)
+        pipe.exists(session_key(sid, 'meta'))
+        queue(pipe)
+        exists, *values = pipe.execute()
+        if exists:
+            return values
+        # Not in the per-part layout; it may still be a legacy blob
+        return self._read(sid, queue) if self._migrate(sid) else None
+
+    def create_session(self, sid, data):
+        """Store a new session; returns False if the id is already taken"""
+        # Atomic reservation: only one creator can set the id field of the meta hash
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hsetnx(session_key(sid, 'meta'), 'id', sid)
+        pipe.exists(session_key(sid))
+        reserved, legacy = pipe.execute()
+        if not reserved:
+            return False
+        if legacy:
+            # Taken by a session from an older version that has not been converted yet
+            self.client.delete(session_key(sid, 'meta'))
+            return False
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(session_key(sid, 'meta'), 'created_at', data['created_at'])
+        pipe.set(session_key(sid, 'settings'), json.dumps(data.get('settings', {})))
+        pipe.set(session_key(sid, 'teams'), json.dumps(data.get('teams', [])))
+        pipe.execute()
+        return True
+
+    @staticmethod
+    def _queue_session(pipe, sid):
+        pipe.hgetall(session_key(sid, 'meta'))
+        pipe.get(session_key(sid, 'settings'))
+        pipe.lrange(session_key(sid, 'surveys'), 0, -1)
+        pipe.get(session_key(sid, 'teams'))
+
+    def get_session(self, sid):
+        """Whole session as a dict, or None if it does not exist"""
+        with stage('redis'):
+            values = self._read(sid, lambda pipe: self._queue_session(pipe, sid))
+        if values is None:
+            return None
+        return self._decode_session(sid, *values)
+
+    def get_sessions(self, sids):
+        """Several whole sessions read in one round trip, as a dict with None for missing ones"""
+        pipe = self.client.pipeline(transaction=False)
+        for sid in sids:
+            pipe.exists(session_key(sid, 'meta'))
+            self._queue_session(pipe, sid)
+        with stage('redis'):
+            values = pipe.execute()
+        sessions = {}
+        for i, sid in enumerate(sids):
+            exists, *parts = values[5 * i:5 * i + 5]
+            # Sessions not in the per-part layout go through the legacy migration one by one
+            sessions[sid] = self._decode_session(sid, *parts) if exists else self.get_session(sid)
+        return sessions
+
+    def _decode_session(self, sid, meta, settings, surveys, teams):
+        with stage('decode'):
+            return {
+                'id': meta.get('id', sid),
+                'created_at': meta.get('created_at'),
+                'surveys': [json.loads(s) for s in surveys],
+                'teams': json.loads(teams) if teams else [],
+                'settings': json.loads(settings) if settings else {}
+            }
+
+    def get_settings(self, sid):
+        values = self._read(sid, lambda pipe: pipe.get(session_key(sid, 'settings')))
+        if values is None:
+            return None
+        return json.loads(values[0]) if values[0] else {}
+
+    def set_settings(self, sid, settings):
+        self.client.set(session_key(sid, 'settings'), json.dumps(settings))
+
+    def next_survey_number(self, sid):
+        """Atomically reserve a number for a survey submitted without an id"""
+        return self.client.incr(session_key(sid, 'seq')) - 1
+
+    def append_survey(self, sid, survey):
+        """Append a survey; returns its position in the session's survey list"""
+        return self.client.rpush(session_key(sid, 'surveys'), json.dumps(survey)) - 1
+
+    def reserve_survey_numbers(self, sid, count):
+        """Reserve count consecutive survey numbers; returns the first"""
+        return self.client.incrby(session_key(sid, 'seq'), count) - count
+
+    def append_surveys(self, sid, surveys):
+        """Append a batch of surveys in one RPUSH; returns the position of the first"""
+        return self.client.rpush(session_key(sid, 'surveys'), *[json.dumps(s) for s in surveys]) - len(surveys)
+
+    def get_surveys(self, sid):
+        with stage('redis'):
+            values = self._read(sid, lambda pipe: pipe.lrange(session_key(sid, 'surveys'), 0, -1))
+        if values is None:
+            return None
+        with stage('decode'):
+            return [json.loads(s) for s in values[0]]
+
+    def survey_count(self, sid):
+        return self.client.llen(session_key(sid, 'surveys'))
+
+    def iter_surveys(self, sid, batch_size=1000):
+        """Yield the session's surveys, reading batch_size of them per request"""
+        start = 0
+        while True:
+            chunk = self.client.lrange(session_key(sid, 'surveys'), start, start + batch_size - 1)
+            for survey in chunk:
+                yield json.loads(survey)
+            if len(chunk) < batch_size:
+                return
+            start += batch_size
+
+    def get_teams(self, sid):
+        values = self._read(sid, lambda pipe: pipe.get(session_key(sid, 'teams')))
+        if values is None:
+            return None
+        return json.loads(values[0]) if values[0] else []
+
+    def get_teams_json(self, sid, anonymous=False):
+        """Stored teams as serialized JSON, or None if there are none for this variant"""
+        return self.client.get(session_key(sid, 'teams_anonymous' if anonymous else 'teams'))
+
+    def set_teams(self, sid, teams, anonymous_teams):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.set(session_key(sid, 'teams'), json.dumps(teams))
+        pipe.set(session_key(sid, 'teams_anonymous'), json.dumps(anonymous_teams))
+        pipe.execute()
+
+    def set_teams_many(self, teams_by_session):
+        """set_teams for several sessions (id -> (teams, anonymous teams)) in one round trip"""
+        pipe = self.client.pipeline(transaction=False)
+        for sid, (teams, anonymous_teams) in teams_by_session.items():
+            pipe.set(session_key(sid, 'teams'), json.dumps(teams))
+            pipe.set(session_key(sid, 'teams_anonymous'), json.dumps(anonymous_teams))
+        pipe.execute()
+
+    def create_job(self, job_id, fields):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(f"job:{job_id}", mapping={k: json.dumps(v) for k, v in fields.items()})
+        pipe.expire(f"job:{job_id}", JOB_TTL)
+        pipe.execute()
+
+    def update_job(self, job_id, fields):
+        # HSET only touches the given fields, so progress and result updates do not clash
+        self.client.hset(f"job:{job_id}", mapping={k: json.dumps(v) for k, v in fields.items()})
+
+    def get_job(self, job_id):
+        job = self.client.hgetall(f"job:{job_id}")
+        return {k: json.loads(v) for k, v in job.items()} if job else None
+
+    def get_cached(self, key):
+        value = self.client.get(key)
+        return json.loads(value) if value else None
+
+    def set_cached(self, key, value, ttl):
+        self.client.setex(key, ttl, json.dumps(value))
+
+class MemoryStorage:
+    """In-process equivalent of RedisStorage, used when Redis is not available"""
+
+    def __init__(self):
+        self.sessions = {}
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def session_exists(self, sid):
+        return sid in self.sessions
+
+    def create_session(self, sid, data):
+        with self._lock:
+            if sid in self.sessions:
+                return False
+            self.sessions[sid] = {
+                'meta': {'id': sid, 'created_at': data['created_at']},
+                'settings': json.dumps(data.get('settings', {})),
+                'surveys': [],
+                'seq': 0,
+                'teams': json.dumps(data.get('teams', []))
+            }
+            return True
+
+    def get_session(self, sid):
+        session = self.sessions.get(sid)
+        if session is None:
+            return None
+        with stage('decode'):
+            return {
+                'id': session['meta']['id'],
+                'created_at': session['meta']['created_at'],
+                'surveys': [json.loads(s) for s in session['surveys']],
+                'teams': json.loads(session['teams']),
+                'settings': json.loads(session['settings'])
+            }
+
+    def get_sessions(self, sids):
+        return {sid: self.get_session(sid) for sid in sids}
+
+    def get_settings(self, sid):
+        session = self.sessions.get(sid)
+        return json.loads(session['settings']) if session else None
+
+    def set_settings(self, sid, settings):
+        self.sessions[sid]['settings'] = json.dumps(settings)
+
+    def next_survey_number(self, sid):
+        with self._lock:
+            session = self.sessions[sid]
+            session['seq'] += 1
+            return session['seq'] - 1
+
+    def append_survey(self, sid, survey):
+        # Stored serialized, like in Redis, so callers cannot mutate stored surveys
+        with self._lock:
+            surveys = self.sessions[sid]['surveys']
+            surveys.append(json.dumps(survey))
+            return len(surveys) - 1
+
+    def reserve_survey_numbers(self, sid, count):
+        with self._lock:
+            session = self.sessions[sid]
+            session['seq'] += count
+            return session['seq'] - count
+
+    def append_surveys(self, sid, surveys):
+        with self._lock:
+            stored = self.sessions[sid]['surveys']
+            stored.extend(json.dumps(s) for s in surveys)
+            return len(stored) - len(surveys)
+
+    def get_surveys(self, sid):
+        session = self.sessions.get(sid)
+        if session is None:
+            return None
+        with stage('decode'):
+            return [json.loads(s) for s in session['surveys']]
+
+    def survey_count(self, sid):
+        return len(self.sessions[sid]['surveys'])
+
+    def iter_surveys(self, sid, batch_size=1000):
+        stored = self.sessions[sid]['surveys']
+        # Bounded by the length now, so surveys appended meanwhile are not included
+        for i in range(len(stored)):
+            yield json.loads(stored[i])
+
+    def get_teams(self, sid):
+        session = self.sessions.get(sid)
+        return json.loads(session['teams']) if session else None
+
+    def get_teams_json(self, sid, anonymous=False):
+        session = self.sessions.get(sid)
+        return session.get('teams_anonymous' if anonymous else 'teams') if session else None
+
+    def set_teams(self, sid, teams, anonymous_teams):
+        with self._lock:
+            session = self.sessions[sid]
+            session['teams'] = json.dumps(teams)
+            session['teams_anonymous'] = json.dumps(anonymous_teams)
+
+    def set_teams_many(self, teams_by_session):
+        for sid, (teams, anonymous_teams) in teams_by_session.items():
+            self.set_teams(sid, teams, anonymous_teams)
+
+    def create_job(self, job_id, fields):
+        with self._lock:
+            self.jobs[job_id] = dict(fields)
+
+    def update_job(self, job_id, fields):
+        with self._lock:
+            if job_id in self.jobs:
+                self.jobs[job_id].update(fields)
+
+    def get_job(self, job_id):
+        job = self.jobs.get(job_id)
+        return dict(job) if job else None
+
+    def get_cached(self, key):
+        # The in-process LRU tier of the result cache already covers this backend
+        return None
+
+    def set_cached(self, key, value, ttl):
+        pass
+
+def create_storage(redis_client):
+    """Storage backend for the given Redis client, or in-memory if there is none"""
+    if redis_client is not None:
+        return RedisStorage(redis_client)
+    return MemoryStorage()
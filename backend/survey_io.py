@@ -0,0 +1,174 @@
+# backend/survey_io.py
+
+import io
+import codecs
+import csv
+import json
+import math
+from datetime import datetime
+
+# Surveys written to storage per pipelined batch
+IMPORT_BATCH_SIZE = 500
+# Surveys read from storage per batch when exporting
+EXPORT_BATCH_SIZE = 1000
+# Rejected rows reported back in detail; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+IMPORT_FORMATS = ('csv', 'ndjson')
+
+class SurveyError(ValueError):
+    """A survey that does not fit the session's characteristics"""
+
+def text_lines(stream):
+    """Decode a binary request stream line by line, skipping a UTF-8 BOM
+
+    Only readline() is used: under gunicorn the request stream is its own
+    body reader rather than an io stream that TextIOWrapper could wrap.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    for line in iter(stream.readline, b''):
+        yield decoder.decode(line)
+    rest = decoder.decode(b'', final=True)
+    if rest:
+        yield rest
+
+def parse_csv(stream):
+    """Yield (line number, row) for every data row of a CSV stream with a header"""
+    reader = csv.DictReader(text_lines(stream))
+    for row in reader:
+        # Cells beyond the header end up under None and are ignored
+        yield reader.line_num, {key: value for key, value in row.items() if key is not None}
+
+def parse_ndjson(stream):
+    """Yield (line number, row) for every non-empty line of an NDJSON stream"""
+    for line_num, line in enumerate(text_lines(stream), 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_num, SurveyError(f"invalid JSON: {e}")
+            continue
+        yield line_num, row if isinstance(row, dict) else SurveyError("expected a JSON object")
+
+PARSERS = {'csv': parse_csv, 'ndjson': parse_ndjson}
+
+def _number(value):
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if not isinstance(value, (int, float)):
+        value = float(str(value).strip())
+        if value.is_integer():
+            value = int(value)
+    if not math.isfinite(value):
+        raise ValueError(value)
+    return value
+
+def validate_survey(row, characteristics):
+    """Survey from a submission or imported row: empty fields dropped, characteristics as numbers
+
+    Every characteristic must be present and a finite number; numeric
+    strings from forms and CSV cells are converted here, once, so surveys
+    are stored typed and the team logic never has to parse them.
+    """
+    if isinstance(row, SurveyError):
+        raise row
+    if not isinstance(row, dict):
+        raise SurveyError("expected a JSON object")
+    survey = {key: value for key, value in row.items() if value is not None and value != ''}
+    for char in characteristics:
+        if char not in survey:
+            raise SurveyError(f"missing {char}")
+        try:
+            survey[char] = _number(survey[char])
+        except ValueError:
+            raise SurveyError(f"{char} is not a number: {survey[char]!r}")
+    if 'id' in survey:
+        survey['id'] = str(survey['id'])
+    return survey
+
+def complete_survey(survey, anonymous):
+    """Fill in name and timestamp the way a single submission does"""
+    # In anonymous mode, ensure we have a name for the backend
+    if anonymous and 'name' not in survey:
+        survey['name'] = f'Anonymous User {survey["id"]}'
+    if 'timestamp' not in survey:
+        survey['timestamp'] = datetime.now().isoformat()
+    return survey
+
+def import_surveys(storage, session_id, rows, characteristics, anonymous=False,
+                   batch_size=IMPORT_BATCH_SIZE, on_batch=None):
+    """Validate parsed rows and append them to a session in batches
+
+    rows yields (line number, row) pairs as produced by parse_csv or
+    parse_ndjson. Only one batch is held in memory at a time; invalid rows
+    are skipped and reported. on_batch, if given, is called with the stored
+    surveys and the index of the first one after every batch.
+    """
+    imported = rejected = 0
+    errors = []
+    batch = []
+
+    def flush():
+        # Ids for rows without one are reserved for the whole batch at once
+        missing = sum(1 for survey in batch if 'id' not in survey)
+        number = storage.reserve_survey_numbers(session_id, missing) if missing else 0
+        for survey in batch:
+            if 'id' not in survey:
+                survey['id'] = f'user_{number}'
+                number += 1
+            complete_survey(survey, anonymous)
+        start = storage.append_surveys(session_id, batch)
+        if on_batch:
+            on_batch(batch, start)
+        return start + len(batch)
+
+    count = storage.survey_count(session_id)
+    for line_num, row in rows:
+        try:
+            batch.append(validate_survey(row, characteristics))
+        except SurveyError as e:
+            rejected += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({'line': line_num, 'error': str(e)})
+            continue
+        if len(batch) >= batch_size:
+            count = flush()
+            imported += len(batch)
+            batch = []
+    if batch:
+        count = flush()
+        imported += len(batch)
+    return {'imported': imported, 'rejected': rejected, 'errors': errors, 'survey_count': count}
+
+def _csv_chunks(rows, columns):
+    """Yield CSV text for rows, in chunks of a few KB"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() > 8192:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def export_surveys_csv(surveys, characteristics):
+    """Yield CSV text for surveys: id, name, timestamp and the characteristics"""
+    return _csv_chunks(surveys, ['id', 'name', 'timestamp'] + list(characteristics))
+
+def export_ndjson(records):
+    """Yield one JSON line per record"""
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+def team_rows(teams):
+    """Flatten teams into one record per member, numbered from 1"""
+    for team_no, team in enumerate(teams, 1):
+        for member in team:
+            yield {'team': team_no, 'id': member.get('id'), 'name': member.get('name')}
+
+def export_teams_csv(teams):
+    """Yield CSV text with one team, id, name row per member"""
+    return _csv_chunks(team_rows(teams), ['team', 'id', 'name'])
@@ -1,8 +1,22 @@
 # backend/team_logic.py
 
+import time
+import logging
+import secrets
 import numpy as np
-import pandas as pd
-from itertools import combinations
+from similarity import (BLOCK_BYTES, as_similarity, block_rows, build_feature_matrix, build_similarity,
+                        similarity_block)
+from optimizer import DEFAULT_TIME_BUDGET, labels_from_teams, mean_team_thi, optimize_teams, teams_from_labels
+from constraints import ConstraintSet, validate_constraints
+from log_config import get_logger, log_event
+
+logger = get_logger('team_logic')
+
+# Starting points for homogeneous teams
+GROUPINGS = ('knn', 'sorted')
+
+# Seeds are drawn below this, so they stay exact as JSON numbers in a browser
+MAX_SEED = 2 ** 31
 
 def calculate_similarity(user1, user2, characteristics):
     """Calculate similarity between two users based on selected characteristics"""
@@ -24,20 +38,12 @@ def calculate_thi(team, similarity_matrix, user_indices):
     if len(team) < 2:
         return 0
     
-    # Get all pairs of team members
-    pairs = list(combinations(team, 2))
-    total_similarity = 0
-    
-    for pair in pairs:
-        # Get indices in the similarity matrix
-        idx1 = user_indices[pair[0]]
-        idx2 = user_indices[pair[1]]
-        total_similarity += similarity_matrix[idx1][idx2]
-    
-    # Average similarity
-    avg_similarity = total_similarity / len(pairs)
+    # Similarities of all member pairs in one lookup
+    indices = [user_indices[member] for member in team]
+    block = as_similarity(similarity_matrix).block(indices)
+    upper = np.triu_indices(len(indices), 1)
     # THI is 1 - average similarity (higher THI = more heterogeneous)
-    return 1 - avg_similarity
+    return 1 - float(block[upper].mean())
 
 def calculate_team_metrics(team, characteristics):
     """Calculate metrics for a team based on the selected characteristics"""
@@ -49,138 +55,353 @@ def calculate_team_metrics(team, characteristics):
     if len(team) < 2:
         return metrics
     
-    # Calculate average similarity
-    total_similarity = 0
-    pairs = 0
+    scores = score_teams(build_feature_matrix(team, characteristics), np.zeros(len(team), dtype=np.int64))
+    metrics['avg_similarity'] = scores['teams'][0]['avg_similarity']
+    metrics['thi'] = scores['teams'][0]['thi']
+    return metrics
+
+def _team_pair_sums(padded, mask):
+    """Sum of pair similarities per team for teams padded to a common size"""
+    num_teams, width, k = padded.shape
+    pair_sums = np.zeros(num_teams)
+    upper = np.triu(np.ones((width, width), dtype=bool), 1)
+    # Teams per chunk so the pairwise differences fit the scratch budget
+    chunk = max(1, BLOCK_BYTES // max(1, width * width * k * 8))
+    for start in range(0, num_teams, chunk):
+        block = padded[start:start + chunk]
+        valid = mask[start:start + chunk]
+        diff = block[:, :, None, :] - block[:, None, :, :]
+        similarity = 1 / (1 + np.sqrt(np.einsum('tijk,tijk->tij', diff, diff)))
+        pairs = valid[:, :, None] & valid[:, None, :] & upper
+        pair_sums[start:start + chunk] = np.where(pairs, similarity, 0).sum(axis=(1, 2))
+    return pair_sums
+
+def _large_team_pair_sum(team_features):
+    """Sum of pair similarities of one team too large to pad, computed in row blocks"""
+    total = 0.0
+    step = block_rows(len(team_features))
+    for start in range(0, len(team_features), step):
+        total += similarity_block(team_features, start, min(start + step, len(team_features))).sum()
+    # Every pair is counted twice and the diagonal adds 1 per member
+    return (total - len(team_features)) / 2
+
+def score_teams(features, labels, characteristics=None):
+    """Score every team of an assignment at once
+
+    features is the (N, k) feature matrix and labels the team number of each
+    user. Returns per-team and session-wide metrics: average pair similarity,
+    THI, spread (standard deviation) of each characteristic and balance,
+    1 / (1 + distance of the team's mean profile from the cohort mean), where
+    1 means the team mirrors the whole cohort.
+    """
+    features = np.asarray(features, dtype=np.float64)
+    labels = np.asarray(labels, dtype=np.int64)
+    # Users without a team (label -1) are left out
+    assigned = labels >= 0
+    features, labels = features[assigned], labels[assigned]
+    n, k = features.shape
+    if characteristics is None:
+        characteristics = [str(c) for c in range(k)]
+    num_teams = int(labels.max()) + 1 if n else 0
+    if not num_teams:
+        return {'teams': [], 'session': {'teams': 0, 'avg_similarity': 0.0, 'thi': 0.0, 'balance': 0.0,
+                                         'spread': {char: 0.0 for char in characteristics}}}
+    sizes = np.bincount(labels, minlength=num_teams)
     
-    for i in range(len(team)):
-        for j in range(i+1, len(team)):
-            similarity = calculate_similarity(team[i], team[j], characteristics)
-            total_similarity += similarity
-            pairs += 1
+    # Per-team means and spreads from grouped sums
+    counts = np.maximum(sizes, 1)[:, None]
+    sums = np.stack([np.bincount(labels, weights=features[:, c], minlength=num_teams) for c in range(k)], axis=1)
+    squares = np.stack([np.bincount(labels, weights=features[:, c] ** 2, minlength=num_teams) for c in range(k)], axis=1)
+    means = sums / counts
+    spread = np.sqrt(np.maximum(squares / counts - means ** 2, 0))
+    balance = 1 / (1 + np.linalg.norm(means - features.mean(axis=0), axis=1))
     
-    if pairs > 0:
-        metrics['avg_similarity'] = total_similarity / pairs
-        metrics['thi'] = 1 - metrics['avg_similarity']  # THI is 1 - average similarity
+    # Pair similarities: pad teams to a common width and reduce all of them together
+    width = int(sizes.max())
+    if width * width * k * 8 <= BLOCK_BYTES:
+        order = np.argsort(labels, kind='stable')
+        starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        sorted_labels = labels[order]
+        position = np.arange(n) - starts[sorted_labels]
+        padded = np.zeros((num_teams, width, k))
+        mask = np.zeros((num_teams, width), dtype=bool)
+        padded[sorted_labels, position] = features[order]
+        mask[sorted_labels, position] = True
+        pair_sums = _team_pair_sums(padded, mask)
+    else:
+        pair_sums = np.array([_large_team_pair_sum(features[labels == t]) for t in range(num_teams)])
+    pairs = sizes * (sizes - 1) / 2
+    avg_similarity = np.divide(pair_sums, pairs, out=np.zeros(num_teams), where=pairs > 0)
+    thi = np.where(pairs > 0, 1 - avg_similarity, 0.0)
     
-    return metrics
+    teams = [
+        {
+            'size': int(size),
+            'avg_similarity': float(avg),
+            'thi': float(team_thi),
+            'balance': float(team_balance),
+            'spread': dict(zip(characteristics, team_spread))
+        }
+        for size, avg, team_thi, team_balance, team_spread
+        in zip(sizes.tolist(), avg_similarity, thi, balance, spread.tolist())
+    ]
+    session = {
+        'teams': num_teams,
+        'avg_similarity': float(avg_similarity.mean()),
+        'thi': float(thi.mean()),
+        'balance': float(balance.mean()),
+        'spread': dict(zip(characteristics, spread.mean(axis=0).tolist()))
+    }
+    return {'teams': teams, 'session': session}
+
+def team_sizes(num_users, team_size, balanced=False):
+    """Sizes of the teams: full teams plus one smaller team for any remainder
+
+    With balanced, the same number of teams with sizes differing by at most one.
+    """
+    if balanced and num_users:
+        num_teams = -(-num_users // team_size)
+        base, extra = divmod(num_users, num_teams)
+        return [base + 1] * extra + [base] * (num_teams - extra)
+    sizes = [team_size] * (num_users // team_size)
+    if num_users % team_size:
+        sizes.append(num_users % team_size)
+    return sizes
+
+def snake_draft(scores, team_size, balanced=False):
+    """Spread users over teams by snake-drafting them in order of descending score
+
+    Every team picks in turn, with the pick order reversed each round, so
+    each team gets a mix of high and low scorers. Runs in O(N log N).
+    """
+    sizes = np.array(team_sizes(len(scores), team_size, balanced))
+    if not len(sizes):
+        return []
+    num_teams = len(sizes)
+    # Highest score first; stable so equal scores keep submission order
+    order = np.argsort(-np.asarray(scores, dtype=np.float64), kind='stable')
+    forward = np.arange(num_teams)
+    picks = []
+    for round_no in range(int(sizes.max())):
+        round_order = forward if round_no % 2 == 0 else forward[::-1]
+        # Skip the smaller teams once they are full
+        picks.append(round_order[sizes[round_order] > round_no])
+    labels = np.empty(len(order), dtype=np.int64)
+    labels[order] = np.concatenate(picks)
+    return teams_from_labels(labels, num_teams)
+
+class BruteForceIndex:
+    """Exact k-NN by full scan, used when scikit-learn is not installed"""
+
+    def __init__(self, data):
+        self.data = np.asarray(data, dtype=np.float64)
 
-def make_teams(users, team_size, team_approach, characteristics, similarity_threshold):
-    print(f"Starting team generation with {len(users)} users")
-    print(f"Team size: {team_size}, Approach: {team_approach}")
-    print(f"Characteristics: {characteristics}")
-    print(f"User data: {users}")
+    def query(self, points, k):
+        diff = np.asarray(points, dtype=np.float64)[:, None, :] - self.data[None, :, :]
+        dist = np.einsum('ijk,ijk->ij', diff, diff)
+        ind = np.argsort(dist, axis=1, kind='stable')[:, :k]
+        return np.sqrt(np.take_along_axis(dist, ind, axis=1)), ind
+
+def build_neighbor_index(data):
+    """KD-tree over the given feature rows (brute force without scikit-learn)"""
+    try:
+        # Imported here: scikit-learn takes about a second to load
+        from sklearn.neighbors import KDTree
+    except ImportError:
+        return BruteForceIndex(data)
+    return KDTree(np.asarray(data, dtype=np.float64))
+
+def nearest_neighbor_teams(features, team_size, balanced=False):
+    """Build homogeneous teams by pulling each seed's nearest unassigned neighbours
+
+    Seeds are taken from the outside in (farthest from the centroid first),
+    so outliers get their closest peers before those are used up. Each team
+    is one k-NN query on a KD-tree; the tree is rebuilt over the unassigned
+    users whenever half of its points are taken, which keeps queries short
+    and the whole pass near O(N log N).
+    """
+    features = np.asarray(features, dtype=np.float64)
+    n = len(features)
+    if n == 0:
+        return []
+    centered = features - features.mean(axis=0)
+    order = np.argsort(-np.einsum('ij,ij->i', centered, centered), kind='stable')
+
+    sizes = team_sizes(n, team_size, balanced)
+    assigned = np.zeros(n, dtype=bool)
+    indexed = np.arange(n)  # users covered by the current index
+    index = build_neighbor_index(features)
+    taken_since_build = 0
+    teams = []
+    for seed in order.tolist():
+        if assigned[seed]:
+            continue
+        if taken_since_build * 2 > len(indexed):
+            indexed = np.flatnonzero(~assigned)
+            index = build_neighbor_index(features[indexed])
+            taken_since_build = 0
+        size = sizes[len(teams)]
+        k = min(len(indexed), 2 * size)
+        while True:
+            _, found = index.query(features[seed:seed + 1], k=k)
+            candidates = indexed[found[0]]
+            candidates = candidates[~assigned[candidates] & (candidates != seed)]
+            if len(candidates) >= size - 1 or k == len(indexed):
+                break
+            k = min(len(indexed), 2 * k)
+        team = [seed] + candidates[:size - 1].tolist()
+        assigned[team] = True
+        taken_since_build += len(team)
+        teams.append(team)
+    return teams
+
+def make_teams(users, team_size, team_approach, characteristics, similarity_threshold,
+               optimizer='annealing', time_budget=DEFAULT_TIME_BUDGET, max_iterations=None,
+               return_details=False, features=None, similarity_matrix=None, progress=None,
+               similarity_mode='auto', memory_limit_mb=None, grouping='knn', constraints=None, seed=None):
+    """Group users into teams and optimize the mean team THI
+
+    Homogeneous teams minimize THI, heterogeneous teams maximize it. With
+    return_details the result is a dict holding the teams, the objective and
+    the seed and iteration budget that reproduce them. The settings are
+    described in the README under "Team generation settings".
+    """
+    if grouping not in GROUPINGS:
+        raise ValueError(f"Unknown grouping: {grouping}")
+    # A malformed spec raises ConstraintError rather than being half applied
+    constraints = validate_constraints(constraints)
+    start = time.perf_counter()
+    if seed is None:
+        seed = new_seed()
+    rng = np.random.default_rng(seed)
     
-    # Convert DataFrame to list of dictionaries if it's not already
-    if isinstance(users, pd.DataFrame):
+    # Convert DataFrame to list of dictionaries if it's not already; checked
+    # without importing pandas, which the service itself does not need
+    if hasattr(users, 'to_dict') and hasattr(users, 'reset_index'):
         users_list = users.reset_index().to_dict('records')
     else:
         users_list = users
-    print(f"Converted user data: {users_list}")
     
-    # Calculate similarity matrix
-    similarity_matrix = np.zeros((len(users_list), len(users_list)))
-    for i in range(len(users_list)):
-        for j in range(i+1, len(users_list)):
-            similarity = calculate_similarity(users_list[i], users_list[j], characteristics)
-            similarity_matrix[i][j] = similarity
-            similarity_matrix[j][i] = similarity
+    # Calculate similarities in one batched pass over the feature matrix
+    if features is None:
+        features = build_feature_matrix(users_list, characteristics)
+    if similarity_matrix is None:
+        memory_limit = memory_limit_mb * 1024 * 1024 if memory_limit_mb else None
+        similarity_matrix = build_similarity(features, similarity_mode, memory_limit)
+    if progress:
+        progress(0.1)
     
-    print("Similarity matrix:")
-    print(similarity_matrix)
+    # Seconds spent per stage, reported with the details
+    timings = {'matrix': time.perf_counter() - start}
+    stage_start = time.perf_counter()
     
     # Calculate number of teams needed
     num_teams = len(users_list) // team_size
     if len(users_list) % team_size != 0:
         num_teams += 1
+    balanced = bool(constraints and constraints.get('balanced_sizes'))
     
-    print(f"Creating {num_teams} teams")
+    # Average skill level per user over the selected characteristics
+    avg_skills = features.mean(axis=1) if len(characteristics) else np.zeros(len(users_list))
     
-    teams = []
-    used_indices = set()
-    
-    if team_approach == 'homogeni':
-        # For homogeneous teams, sort users by their average skill level
-        user_avg_skills = []
-        for i, user in enumerate(users_list):
-            avg_skill = np.mean([float(user.get(char, 0)) for char in characteristics])
-            user_avg_skills.append((i, avg_skill))
-        
-        # Sort by average skill level
-        user_avg_skills.sort(key=lambda x: x[1])
-        sorted_indices = [x[0] for x in user_avg_skills]
-        
-        # Create teams with similar skill levels
-        current_team = []
-        for i in sorted_indices:
-            if i not in used_indices:
-                user = users_list[i]
-                current_team.append(user.get('id', str(i)))
-                used_indices.add(i)
-                
-                if len(current_team) == team_size:
-                    teams.append(current_team)
-                    current_team = []
-        
-        # Add any remaining users to the last team
-        if current_team:
-            teams.append(current_team)
+    if team_approach == 'homogeni' and grouping == 'knn' and len(characteristics):
+        # For homogeneous teams, group each user with their nearest neighbours
+        teams = nearest_neighbor_teams(features, team_size, balanced)
+    
+    elif team_approach == 'homogeni':
+        # Sort users by their average skill level and cut the sorted order into consecutive teams
+        sorted_indices = np.argsort(avg_skills, kind='stable')
+        bounds = np.cumsum([0] + team_sizes(len(sorted_indices), team_size, balanced))
+        teams = [sorted_indices[a:b].tolist() for a, b in zip(bounds[:-1], bounds[1:])]
     
     else:  # heterogeneous
-        # For heterogeneous teams, sort users by their average skill level
-        user_avg_skills = []
-        for i, user in enumerate(users_list):
-            avg_skill = np.mean([float(user.get(char, 0)) for char in characteristics])
-            user_avg_skills.append((i, avg_skill))
-        
-        # Sort by average skill level
-        user_avg_skills.sort(key=lambda x: x[1])
-        sorted_indices = [x[0] for x in user_avg_skills]
-        
-        # Create teams with diverse skill levels
-        current_team = []
-        while len(used_indices) < len(users_list):
-            if not current_team:
-                # Start with highest skill user
-                for i in reversed(sorted_indices):
-                    if i not in used_indices:
-                        user = users_list[i]
-                        current_team.append(user.get('id', str(i)))
-                        used_indices.add(i)
-                        break
-            else:
-                # Find most different user
-                current_avg = np.mean([
-                    np.mean([float(users_list[sorted_indices.index(j)].get(char, 0)) for char in characteristics])
-                    for j in [sorted_indices.index(int(uid)) for uid in current_team]
-                ])
-                
-                best_idx = -1
-                max_diff = -1
-                for i in sorted_indices:
-                    if i not in used_indices:
-                        user_avg = np.mean([float(users_list[i].get(char, 0)) for char in characteristics])
-                        diff = abs(user_avg - current_avg)
-                        if diff > max_diff:
-                            max_diff = diff
-                            best_idx = i
-                
-                if best_idx != -1:
-                    user = users_list[best_idx]
-                    current_team.append(user.get('id', str(best_idx)))
-                    used_indices.add(best_idx)
-            
-            if len(current_team) == team_size:
-                teams.append(current_team)
-                current_team = []
-        
-        # Add any remaining users to the last team
-        if current_team:
-            teams.append(current_team)
-    
-    print(f"Final teams: {teams}")
+        teams = snake_draft(avg_skills, team_size, balanced)
+    
+    if progress:
+        progress(0.2)
+    
+    timings['grouping'] = time.perf_counter() - stage_start
+    constraint_set = None
+    if constraints:
+        stage_start = time.perf_counter()
+        constraint_set = ConstraintSet(constraints, users_list, labels_from_teams(teams, len(users_list)))
+        if constraint_set:
+            constraint_set.repair(rng)
+            teams = teams_from_labels(constraint_set.labels, len(teams))
+        timings['constraints'] = time.perf_counter() - stage_start
+    stage_start = time.perf_counter()
+    if optimizer and len(teams) > 1:
+        # Homogeneous teams want low THI, heterogeneous teams high THI
+        maximize = team_approach != 'homogeni'
+        target = None
+        if not maximize and similarity_threshold is not None:
+            target = 1 - float(similarity_threshold) / 100
+        teams, details = optimize_teams(
+            similarity_matrix, teams, maximize,
+            optimizer=optimizer,
+            time_budget=time_budget,
+            max_iterations=max_iterations,
+            target=target,
+            rng=rng,
+            progress=(lambda done: progress(0.2 + 0.8 * done)) if progress else None,
+            constraints=constraint_set or None
+        )
+    else:
+        details = {'optimizer': None, 'objective': mean_team_thi(similarity_matrix, teams)}
+    
+    timings['optimize'] = time.perf_counter() - stage_start
+    details['seed'] = seed
+    if constraint_set is not None:
+        constraint_set.relax_unmet()
+        details['constraints'] = constraint_set.report()
+        if details['constraints']['relaxed']:
+            log_event(logger, logging.WARNING, "constraints relaxed",
+                      relaxed=len(details['constraints']['relaxed']),
+                      violations=details['constraints']['violations'])
+    if return_details:
+        # Quality of every team, scored in one batch
+        stage_start = time.perf_counter()
+        details['metrics'] = score_teams(features, labels_from_teams(teams, len(users_list)), characteristics)
+        timings['scoring'] = time.perf_counter() - stage_start
+    details['timings'] = timings
+    
+    # Map user indices back to survey ids
+    teams = [[users_list[i].get('id', str(i)) for i in team] for team in teams]
+    
+    log_event(logger, logging.INFO, "teams generated",
+              users=len(users_list), teams=num_teams, team_size=team_size, approach=team_approach,
+              characteristics=len(characteristics), optimizer=details['optimizer'],
+              initial_objective=details.get('initial_objective', details['objective']),
+              objective=details['objective'], iterations=details.get('iterations', 0), seed=seed,
+              timed_out=details.get('timed_out', False),
+              matrix_seconds=timings['matrix'], seconds=time.perf_counter() - start)
+    if progress:
+        progress(1.0)
+    if return_details:
+        return dict(details, teams=teams)
     return teams
 
+def new_seed():
+    """Random seed for a search whose caller did not fix one"""
+    return secrets.randbelow(MAX_SEED)
+
+def restart_seeds(seed, restarts):
+    """Seeds of independent restarts: seed, seed + 1, ... (from a random seed if None)"""
+    seed = new_seed() if seed is None else int(seed)
+    return [seed + i for i in range(restarts)]
+
+def best_result(results, team_approach):
+    """Best of several make_teams results (with details) for the same users
 
+    Fewest constraint violations first, then the best objective: lowest
+    mean THI for homogeneous teams, highest otherwise. The seed and
+    objective of every run are listed under 'restarts'.
+    """
+    sign = 1.0 if team_approach == 'homogeni' else -1.0
 
+    def rank(result):
+        violations = (result.get('constraints') or {}).get('violations', 0)
+        return violations, sign * result['objective']
 
+    best = min(results, key=rank)
+    return dict(best, restarts=[{'seed': r['seed'], 'objective': r['objective']} for r in results])
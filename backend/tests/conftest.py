@@ -0,0 +1,7 @@
+# backend/tests/conftest.py
+
+import os
+import sys
+
+# The backend uses flat imports (from constraints import ...), as when run from backend/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
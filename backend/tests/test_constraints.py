@@ -0,0 +1,111 @@
+# backend/tests/test_constraints.py
+
+import numpy as np
+import pytest
+from constraints import ConstraintError, ConstraintSet, validate_constraints
+from optimizer import labels_from_teams
+
+def make_users(n, leaders=()):
+    return [{'id': f'u{i}', 'lead': 5 if i in leaders else 1} for i in range(n)]
+
+def consecutive_labels(n, team_size):
+    return labels_from_teams([list(range(i, min(i + team_size, n))) for i in range(0, n, team_size)], n)
+
+def violations(constraint_set):
+    return [constraint.violations() for constraint in constraint_set.constraints]
+
+def test_swap_delta_matches_recount_after_random_swaps():
+    users = make_users(40, leaders=range(0, 40, 3))
+    spec = {
+        # Overlapping groups are merged into one
+        'must_pair': [['u0', 'u7', 'u13'], ['u13', 'u21'], {'members': ['u30', 'u31'], 'hard': False}],
+        'must_separate': [['u1', 'u2', 'u3', 'u4'], {'members': ['u7', 'u22', 'u23'], 'hard': False}],
+        'min_per_team': [{'characteristic': 'lead', 'min_value': 4, 'count': 1},
+                         {'characteristic': 'lead', 'min_value': 4, 'count': 2, 'hard': False}]
+    }
+    constraint_set = ConstraintSet(spec, users, consecutive_labels(40, 4))
+    rng = np.random.default_rng(0)
+    swaps = 0
+    while swaps < 500:
+        a, b = rng.integers(0, 40, size=2).tolist()
+        if constraint_set.labels[a] == constraint_set.labels[b]:
+            continue
+        hard, soft = constraint_set.swap_delta(a, b)
+        before = constraint_set.hard_violations, constraint_set.soft_violations
+        constraint_set.apply_swap(a, b, hard, soft)
+        swaps += 1
+        recount = ConstraintSet(spec, users, constraint_set.labels)
+        assert (recount.hard_violations, recount.soft_violations) == (before[0] + hard, before[1] + soft)
+        assert (constraint_set.hard_violations, constraint_set.soft_violations) == \
+            (recount.hard_violations, recount.soft_violations)
+        assert violations(constraint_set) == violations(recount)
+        # Members and positions stay consistent with the labels
+        for team, members in enumerate(constraint_set.members):
+            assert all(constraint_set.labels[user] == team for user in members)
+            assert [constraint_set.position[user] for user in members] == list(range(len(members)))
+
+def test_reset_recounts_from_scratch():
+    users = make_users(16, leaders=(0, 1))
+    spec = {'must_pair': [['u0', 'u15']], 'min_per_team': [{'characteristic': 'lead', 'min_value': 4}]}
+    constraint_set = ConstraintSet(spec, users, consecutive_labels(16, 4))
+    start = constraint_set.labels.copy()
+    constraint_set.apply_swap(0, 12)
+    constraint_set.apply_swap(1, 5)
+    constraint_set.reset(start)
+    recount = ConstraintSet(spec, users, start)
+    assert violations(constraint_set) == violations(recount)
+    assert (constraint_set.hard_violations, constraint_set.soft_violations) == \
+        (recount.hard_violations, recount.soft_violations)
+
+def test_repair_gathers_must_pair_group():
+    users = make_users(12)
+    constraint_set = ConstraintSet({'must_pair': [['u0', 'u5', 'u10']]}, users, consecutive_labels(12, 4))
+    assert constraint_set.hard_violations == 2
+    labels = constraint_set.repair(np.random.default_rng(1))
+    assert constraint_set.hard_violations == 0
+    assert labels[0] == labels[5] == labels[10]
+    assert np.bincount(labels).tolist() == [4, 4, 4]
+
+def test_repair_spreads_min_per_team():
+    # All three leaders start in the first team
+    users = make_users(12, leaders=(0, 1, 2))
+    spec = {'min_per_team': [{'characteristic': 'lead', 'min_value': 4, 'count': 1}]}
+    constraint_set = ConstraintSet(spec, users, consecutive_labels(12, 4))
+    assert constraint_set.hard_violations == 2
+    labels = constraint_set.repair(np.random.default_rng(2))
+    assert constraint_set.hard_violations == 0
+    assert sorted(labels[[0, 1, 2]].tolist()) == [0, 1, 2]
+    assert np.bincount(labels).tolist() == [4, 4, 4]
+
+def test_repair_keeps_pairs_while_spreading_leaders():
+    users = make_users(12, leaders=(0, 1, 2))
+    spec = {'must_pair': [['u0', 'u1']],
+            'min_per_team': [{'characteristic': 'lead', 'min_value': 4, 'count': 1, 'hard': False}]}
+    constraint_set = ConstraintSet(spec, users, labels_from_teams([[0, 4, 5, 6], [1, 7, 8, 9], [2, 3, 10, 11]], 12))
+    labels = constraint_set.repair(np.random.default_rng(3))
+    # The hard pair wins over the soft quota, which can then only miss one team
+    assert constraint_set.hard_violations == 0
+    assert labels[0] == labels[1]
+    assert constraint_set.soft_violations == 1
+
+def test_impossible_constraints_are_relaxed():
+    users = make_users(8)
+    spec = {'must_pair': [['u0', 'u1', 'u2', 'u3', 'u4']],
+            'min_per_team': [{'characteristic': 'lead', 'min_value': 4, 'count': 1}]}
+    constraint_set = ConstraintSet(spec, users, consecutive_labels(8, 4))
+    assert [constraint.relaxed for constraint in constraint_set.constraints] == \
+        ['group is larger than a team', 'not enough qualifying users']
+    assert constraint_set.hard_violations == 0
+
+@pytest.mark.parametrize('spec', [
+    'u1',
+    {'must_pair': 'u1'},
+    {'must_pair': [[{'id': 'u1'}]]},
+    {'must_separate': [{'members': ['u1'], 'hard': 'no'}]},
+    {'min_per_team': [{'characteristic': 'lead', 'count': -1}]},
+    {'balanced_sizes': 1},
+    {'unknown': []}
+])
+def test_validate_constraints_rejects_malformed_specs(spec):
+    with pytest.raises(ConstraintError):
+        validate_constraints(spec)
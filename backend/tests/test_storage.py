@@ -0,0 +1,57 @@
+# backend/tests/test_storage.py
+
+import json
+import pytest
+from storage import RedisStorage, session_key
+
+fakeredis = pytest.importorskip('fakeredis')
+
+LEGACY = {
+    'id': '123456',
+    'created_at': '2024-01-01T10:00:00',
+    'settings': {'team_size': 2, 'team_approach': 'heterogeni'},
+    'surveys': [{'id': f'user_{i}', 'name': f'User {i}', 'tech_skills': i} for i in range(3)],
+    'teams': [[{'id': 'user_0', 'name': 'User 0'}, {'id': 'user_1', 'name': 'User 1'}]]
+}
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+@pytest.fixture
+def storage(client):
+    client.set(session_key('123456'), json.dumps(LEGACY))
+    return RedisStorage(client)
+
+def test_legacy_blob_is_split_on_first_read(storage, client):
+    session = storage.get_session('123456')
+    assert session == LEGACY
+    assert not client.exists(session_key('123456'))
+    assert client.hgetall(session_key('123456', 'meta')) == {'id': '123456', 'created_at': LEGACY['created_at']}
+    assert client.llen(session_key('123456', 'surveys')) == 3
+    # Read again from the per-part layout
+    assert storage.get_session('123456') == LEGACY
+
+def test_migrated_session_keeps_numbering_and_appends(storage):
+    assert storage.get_settings('123456') == LEGACY['settings']
+    # Surveys without an id continue after the migrated ones
+    assert storage.next_survey_number('123456') == 3
+    assert storage.append_survey('123456', {'id': 'user_3', 'name': 'User 3'}) == 3
+    assert [survey['id'] for survey in storage.get_surveys('123456')] == [f'user_{i}' for i in range(4)]
+    assert storage.get_teams('123456') == LEGACY['teams']
+    # The anonymized teams are derived later, not carried over
+    assert storage.get_teams_json('123456', anonymous=True) is None
+
+def test_legacy_blob_in_batch_read(storage, client):
+    client.set(session_key('654321'), json.dumps(dict(LEGACY, id='654321', surveys=[])))
+    sessions = storage.get_sessions(['123456', '654321', '000000'])
+    assert sessions['123456'] == LEGACY
+    assert sessions['654321']['surveys'] == []
+    assert sessions['000000'] is None
+
+def test_new_session_cannot_take_a_legacy_id(storage, client):
+    assert storage.session_exists('123456') is True
+    client.set(session_key('222222'), json.dumps(dict(LEGACY, id='222222')))
+    assert not storage.create_session('222222', {'created_at': 'now'})
+    # The legacy session is untouched and still migrates
+    assert storage.get_session('222222')['surveys'] == LEGACY['surveys']